@@ -1,27 +1,58 @@
 """Custom chains for LLM"""
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import SimpleQueue
 
 from langchain import PromptTemplate
 from langchain.base_language import BaseLanguageModel
 from langchain.chains.qa_generation.prompt import PROMPT_SELECTOR
+from langchain.llms import LlamaCpp
 from langchain.schema import Document
 from langchain.vectorstores.base import VectorStoreRetriever
 
 from casalioy.load_env import (
+    llm_tokenizer,
+    mapreduce_group_size,
     model_n_ctx,
+    model_prefix_cache,
     n_forward_documents,
     n_retrieve_documents,
+    refine_min_score,
+    refine_patience,
 )
+from casalioy.prefix_cache import PrefixCache
+from casalioy.reranker import Reranker
 from casalioy.utils import print_HTML
 
+# answer from several extracts, used by StuffQA and by the map step of MapReduceQA
+EXTRACTS_PROMPT = """HUMAN:
+Answer the question using ONLY the given extracts from (possibly unrelated and irrelevant) documents, not your own knowledge.
+If you are unsure of the answer or if it isn't provided in the extracts, answer "Unknown[STOP]".
+Conclude your answer with "[STOP]" when you're finished.
+
+Question: {question}
+
+--------------
+Here are the extracts:
+{context}
+
+--------------
+Remark: do not repeat the question !
+
+ASSISTANT:
+"""
+
 
 class BaseQA:
     """base class for Question-Answering"""
 
-    def __init__(self, llm: BaseLanguageModel, retriever: VectorStoreRetriever, prompt: PromptTemplate = None):
+    def __init__(self, llm: BaseLanguageModel, retriever: VectorStoreRetriever, prompt: PromptTemplate = None, reranker: Reranker | None = None):
         self.llm = llm
         self.retriever = retriever
+        self.reranker = reranker
         self.prompt = prompt or self.default_prompt
         self.retriever.search_kwargs = {**self.retriever.search_kwargs, "k": n_forward_documents, "fetch_k": n_retrieve_documents}
+        self.prefix_caches: dict[int, PrefixCache] = {}  # by LlamaCpp instance, each has its own context
 
     @property
     def default_prompt(self) -> PromptTemplate:
@@ -29,12 +60,56 @@ class BaseQA:
         return PROMPT_SELECTOR.get_prompt(self.llm)
 
     def fetch_documents(self, search: str) -> list[Document]:
-        """fetch documents from retriever"""
-        return self.retriever.get_relevant_documents(search)
+        """fetch documents from retriever, or with a reranker, the best of the fetch_k most similar documents"""
+        if self.reranker is None:
+            return self.retriever.get_relevant_documents(search)
+        search_kwargs = self.retriever.search_kwargs
+        candidates = self.retriever.vectorstore.similarity_search(search, k=search_kwargs["fetch_k"], filter=search_kwargs.get("filter"))
+        documents = self.reranker.rerank(search, candidates, search_kwargs["k"])
+        print_HTML("<r>Reranked {N} candidates, forwarding {n}</r>", N=len(candidates), n=len(documents))
+        return documents
+
+    @staticmethod
+    def context_prompt_str(documents: list[Document], label: str = "Extract") -> str:
+        """the document's prompt"""
+        prompt = "".join(f"{label} {i + 1}: {document.page_content}\n\n" for i, document in enumerate(documents))
+        return prompt.strip()
+
+    def token_count(self, document: Document) -> int:
+        """tokens of a document's text, counted at ingestion if it was with the LLM's tokenizer"""
+        if document.metadata.get("tokenizer") == llm_tokenizer and "n_tokens" in document.metadata:
+            return document.metadata["n_tokens"]
+        return self.llm.get_num_tokens(document.page_content)
+
+    def pack_documents(self, prompt: PromptTemplate, documents: list[Document], label: str = "Extract", **kwargs: str) -> list[Document]:
+        """the first documents which fit in the prompt's context along with the answer.
+        Each extract is counted once and added to a running total, then the whole prompt is tokenized once to check it:
+        tokens may merge differently across the extracts' boundaries, in which case the last documents are dropped."""
+        budget = model_n_ctx - self.llm.dict()["max_tokens"]
+        total, packed = self.llm.get_num_tokens(prompt.format_prompt(context="", **kwargs).to_string()), []
+        header = self.llm.get_num_tokens(f"{label} {len(documents)}: \n\n")  # at most, for the extract with the longest number
+        for document in documents:
+            total += self.token_count(document) + header
+            if total > budget:
+                break
+            packed.append(document)
+        while packed and self.llm.get_num_tokens(prompt.format_prompt(context=self.context_prompt_str(packed, label), **kwargs).to_string()) > budget:
+            packed.pop()
+        return packed
+
+    def predict(self, prompt: PromptTemplate, llm: BaseLanguageModel | None = None, **kwargs: str) -> str:
+        """complete a prompt with llm (by default the chain's), starting from the cached state of its instructions with LlamaCpp"""
+        llm = llm or self.llm
+        formatted_prompt = prompt.format_prompt(**kwargs).to_string()
+        if model_prefix_cache and isinstance(llm, LlamaCpp):
+            if id(llm) not in self.prefix_caches:
+                self.prefix_caches[id(llm)] = PrefixCache(llm.client, llm.model_path)
+            self.prefix_caches[id(llm)].restore(prompt, formatted_prompt)
+        return llm.predict(formatted_prompt)
 
     def __call__(self, input_str: str) -> dict:
         """ask a question, return results"""
-        return {"result": self.llm.predict(self.default_prompt.format_prompt(question=input_str).to_string())}
+        return {"result": self.predict(self.default_prompt, question=input_str)}
 
 
 class StuffQA(BaseQA):
@@ -46,49 +121,24 @@ class StuffQA(BaseQA):
     @property
     def default_prompt(self) -> PromptTemplate:
         """the default prompt"""
-        prompt = """HUMAN:
-Answer the question using ONLY the given extracts from (possibly unrelated and irrelevant) documents, not your own knowledge.
-If you are unsure of the answer or if it isn't provided in the extracts, answer "Unknown[STOP]".
-Conclude your answer with "[STOP]" when you're finished.
-
-Question: {question}
-
---------------
-Here are the extracts:
-{context}
-
---------------
-Remark: do not repeat the question !
-
-ASSISTANT:
-"""
-        return PromptTemplate(template=prompt, input_variables=["context", "question"])
-
-    @staticmethod
-    def context_prompt_str(documents: list[Document]) -> str:
-        """the document's prompt"""
-        prompt = "".join(f"Extract {i + 1}: {document.page_content}\n\n" for i, document in enumerate(documents))
-        return prompt.strip()
+        return PromptTemplate(template=EXTRACTS_PROMPT, input_variables=["context", "question"])
 
     def __call__(self, input_str: str) -> dict:
-        all_documents, documents = self.fetch_documents(input_str), []
-        for document in all_documents:
-            documents.append(document)
-            context_str = self.context_prompt_str(documents)
-            if (
-                self.llm.get_num_tokens(self.prompt.format_prompt(question=input_str, context=context_str).to_string())
-                > model_n_ctx - self.llm.dict()["max_tokens"]
-            ):
-                documents.pop()
-                break
+        documents = self.pack_documents(self.prompt, self.fetch_documents(input_str), question=input_str)
         print_HTML("<r>Stuffed {n} documents in the context</r>", n=len(documents))
-        context_str = self.context_prompt_str(documents)
-        formatted_prompt = self.prompt.format_prompt(question=input_str, context=context_str).to_string()
-        return {"result": self.llm.predict(formatted_prompt), "source_documents": documents}
+        return {"result": self.predict(self.prompt, question=input_str, context=self.context_prompt_str(documents)), "source_documents": documents}
 
 
 class RefineQA(BaseQA):
-    """custom QA close to a refine chain"""
+    """custom QA close to a refine chain
+    Extracts whose similarity to the question is below min_score are skipped without calling the LLM, and refining stops once
+    the answer has been left unchanged by patience extracts in a row.
+    """
+
+    def __init__(self, *args, min_score: float = refine_min_score, patience: int = refine_patience, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_score = min_score
+        self.patience = patience
 
     @property
     def default_prompt(self) -> PromptTemplate:
@@ -145,16 +195,121 @@ ASSISTANT:
     def __call__(self, input_str: str) -> dict:
         """ask a question"""
         documents = self.fetch_documents(input_str)
-        last_answer, score = None, None
-        for i, doc in enumerate(documents):
-            print_HTML("<r>Refining from document {i}/{N}</r>", i=i + 1, N=len(documents))
-            prompt = self.default_prompt if i == 0 else self.refine_prompt
+        relevant = [doc for doc in documents if doc.metadata.get("score", float("inf")) >= self.min_score] or documents[:1]
+        last_answer, unchanged, used = None, 0, []
+        for i, doc in enumerate(relevant):
+            print_HTML("<r>Refining from document {i}/{N}</r>", i=i + 1, N=len(relevant))
             if i == 0:
-                formatted_prompt = prompt.format_prompt(question=input_str, context=doc.page_content)
+                answer = self.predict(self.default_prompt, question=input_str, context=doc.page_content)
             else:
-                formatted_prompt = prompt.format_prompt(question=input_str, context=doc.page_content, previous_answer=last_answer)
-            last_answer = self.llm.predict(formatted_prompt.to_string())
+                answer = self.predict(self.refine_prompt, question=input_str, context=doc.page_content, previous_answer=last_answer)
+            used.append(doc)
+            unchanged = unchanged + 1 if i > 0 and answer.strip() == last_answer.strip() else 0
+            last_answer = answer
+            if self.patience and unchanged >= self.patience:
+                break
+        print_HTML(
+            "<r>{calls} LLM calls: {skipped} extracts skipped as irrelevant, {left} left once the answer settled</r>",
+            calls=len(used),
+            skipped=len(documents) - len(relevant),
+            left=len(relevant) - len(used),
+        )
         return {
             "result": f"{last_answer}",
-            "source_documents": documents,
+            "source_documents": used,
+            "llm_calls": len(used),
+        }
+
+
+class MapReduceQA(BaseQA):
+    """custom QA close to a map-reduce chain
+    Groups of extracts are answered independently, concurrently on the workers (LLMs with their own context), and each partial
+    answer is printed as soon as it's finished. A last call to the chain's LLM merges the answers which aren't "Unknown".
+    Groups hold group_size extracts (by default, an equal share for each worker), fewer if they don't fit in the context.
+    """
+
+    def __init__(self, *args, workers: list[BaseLanguageModel] | None = None, group_size: int = mapreduce_group_size, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.workers = workers or [self.llm]
+        self.group_size = group_size
+
+    @property
+    def default_prompt(self) -> PromptTemplate:
+        """the default prompt"""
+        return PromptTemplate(template=EXTRACTS_PROMPT, input_variables=["context", "question"])
+
+    @property
+    def reduce_prompt(self) -> PromptTemplate:
+        """prompt to use for the merging step"""
+        prompt = """HUMAN:
+Several answers to the question were written, each from different extracts of documents.
+Combine them into a single answer, using ONLY the information in these answers, not your own knowledge.
+If they contradict each other, say so.
+Conclude your answer with "[STOP]" when you're finished.
+
+Question: {question}
+
+--------------
+Here are the answers:
+{context}
+
+--------------
+Remark: do not repeat the question !
+
+ASSISTANT:
+"""
+        return PromptTemplate(template=prompt, input_variables=["context", "question"])
+
+    @staticmethod
+    def is_unknown(answer: str) -> bool:
+        """whether an answer says the extracts didn't answer the question"""
+        return answer.strip().strip(".").lower() in ("", "unknown")
+
+    def group_documents(self, input_str: str, documents: list[Document]) -> list[list[Document]]:
+        """consecutive groups of documents, each fitting in the context. Documents which don't even fit alone are dropped."""
+        size, groups = self.group_size or math.ceil(len(documents) / len(self.workers)), []
+        while documents:
+            group = self.pack_documents(self.prompt, documents[:size], question=input_str)
+            if group:
+                groups.append(group)
+            documents = documents[max(len(group), 1) :]
+        return groups
+
+    def __call__(self, input_str: str) -> dict:
+        """ask a question"""
+        groups = self.group_documents(input_str, self.fetch_documents(input_str))
+        idle = SimpleQueue()  # each worker answers one group at a time
+        for worker in self.workers:
+            idle.put(worker)
+
+        def answer(group: list[Document]) -> str:
+            llm = idle.get()
+            try:
+                return self.predict(self.prompt, llm=llm, question=input_str, context=self.context_prompt_str(group))
+            finally:
+                idle.put(llm)
+
+        print_HTML("<r>Answering from {N} groups of extracts with {n} workers</r>", N=len(groups), n=len(self.workers))
+        answers: dict[int, str] = {}
+        with ThreadPoolExecutor(max_workers=len(self.workers)) as pool:
+            futures = {pool.submit(answer, group): i for i, group in enumerate(groups)}
+            for future in as_completed(futures):
+                i = futures[future]
+                answers[i] = future.result()
+                print_HTML("<r>Partial answer {i}/{N}:</r> {answer}", i=i + 1, N=len(groups), answer=answers[i].strip())
+
+        known = [i for i in sorted(answers) if not self.is_unknown(answers[i])]
+        if len(known) <= 1:  # nothing to merge
+            result = answers[known[0]] if known else "Unknown"
+            calls = len(groups)
+        else:
+            partial = self.pack_documents(self.reduce_prompt, [Document(page_content=answers[i].strip()) for i in known], label="Answer", question=input_str)
+            known = known[: len(partial)]
+            print_HTML("<r>Merging {n} partial answers</r>", n=len(partial))
+            result = self.predict(self.reduce_prompt, question=input_str, context=self.context_prompt_str(partial, "Answer"))
+            calls = len(groups) + 1
+        return {
+            "result": result,
+            "source_documents": [document for i in known for document in groups[i]],
+            "llm_calls": calls,
         }
@@ -0,0 +1,88 @@
+"""read documents straight from zip and tar archives, without extracting them"""
+import csv
+import io
+import lzma
+import os
+import tarfile
+import tempfile
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Callable, Iterator
+
+from langchain.docstore.document import Document
+
+from casalioy.utils import print_HTML
+
+archive_suffixes = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+archive_errors = (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error, lzma.LZMAError, OSError)  # corrupt or truncated archives
+
+
+def is_archive(filepath: Path) -> bool:
+    """whether a file is an archive, from its name"""
+    return filepath.name.lower().endswith(archive_suffixes)
+
+
+def list_members(filepath: Path) -> list[str]:
+    """names of the files in a zip archive, in order. Tar archives can only be read sequentially, so they aren't split and this is empty."""
+    if not zipfile.is_zipfile(filepath):
+        return []
+    try:
+        with zipfile.ZipFile(filepath) as archive:
+            return [info.filename for info in archive.infolist() if not info.is_dir()]
+    except archive_errors:  # loaded at once, which reports the error
+        return []
+
+
+def iter_members(filepath: Path, members: range | None = None) -> Iterator[tuple[str, bytes]]:
+    """name and content of the files of an archive, or only of the members at these indices of list_members for a zip"""
+    if zipfile.is_zipfile(filepath):
+        with zipfile.ZipFile(filepath) as archive:
+            names = list_members(filepath)
+            for i in members if members is not None else range(len(names)):
+                yield names[i], archive.read(names[i])
+        return
+    with tarfile.open(filepath, "r:*") as archive:  # streamed: each member is decompressed once, in order
+        for info in archive:
+            if info.isfile():
+                yield info.name, archive.extractfile(info).read()
+
+
+def load_txt(data: bytes, source: str) -> list[Document]:
+    return [Document(page_content=data.decode("utf8"), metadata={"source": source})]
+
+
+def load_csv(data: bytes, source: str) -> list[Document]:
+    """same documents as langchain's CSVLoader: one per row"""
+    rows = csv.DictReader(io.StringIO(data.decode("utf8"), newline=""))
+    return [Document(page_content="\n".join(f"{k}: {v}" for k, v in row.items()), metadata={"source": source, "row": i}) for i, row in enumerate(rows)]
+
+
+# loaders reading from memory. PDFs go through the file loader, which extracts them page by page like the files outside archives.
+stream_loaders: dict[str, Callable[[bytes, str], list[Document]]] = {"txt": load_txt, "csv": load_csv}
+
+
+def load_member(name: str, data: bytes, source: str, file_loaders: dict[str, Callable]) -> list[Document]:
+    """load a member of an archive from memory, or through a temporary file for the loaders which need a path"""
+    extension = Path(name).suffix[1:].lower()
+    if extension in stream_loaders:
+        return stream_loaders[extension](data, source)
+    if extension not in file_loaders:
+        return []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, Path(name).name)
+        with open(path, "wb") as f:
+            f.write(data)
+        documents = file_loaders[extension](path).load()
+    for document in documents:
+        document.metadata["source"] = source
+    return documents
+
+
+def load_archive(filepath: Path, file_loaders: dict[str, Callable], members: range | None = None) -> list[Document]:
+    """load the supported files of an archive, with archive!member as their source. A corrupt archive is skipped."""
+    try:
+        return [document for name, data in iter_members(filepath, members) for document in load_member(name, data, f"{filepath}!{name}", file_loaders)]
+    except archive_errors as e:
+        print_HTML("<w>Skipping corrupt archive {fname} in {fparent}: {error}</w>", fname=filepath.name, fparent=filepath.parent, error=e)
+        return []
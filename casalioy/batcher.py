@@ -0,0 +1,84 @@
+"""group the chunks of many documents into embedding batches"""
+import multiprocessing
+import multiprocessing.pool
+import time
+from pathlib import Path
+from typing import Any, Iterator
+
+from langchain.docstore.document import Document
+
+from casalioy.dedup import NearDuplicates
+from casalioy.pipeline import Drained
+
+# (file, PDF pages or zip members to load or None for the whole file, part index, number of parts, estimated bytes of the part)
+LoadTask = tuple[Path, range | None, int, int, int]
+Batch = tuple[list[tuple[str, int]], list[tuple[str, Document]]]  # (files registered with their chunk count, (file key, chunk))
+EmbeddedBatch = tuple[list[tuple[str, int]], list[tuple[str, Any, Document]]]  # (files registered with their chunk count, (file key, embedding, chunk))
+
+
+class ChunkBatcher:
+    """gathers chunks from many files into batches of at most max_size chunks, of similar lengths to reduce padding.
+    A partial batch is flushed if no full batch could be made for timeout seconds.
+    With near_duplicates, chunks close to one already seen are dropped before batching.
+    Each chunk is tagged with the key of its file, and each file is registered with its number of chunks in the batch following its loading,
+    so that the consumer can tell when all the chunks of a file have been embedded.
+    """
+
+    def __init__(self, max_size: int, timeout: float, sort_window: int = 4, near_duplicates: NearDuplicates | None = None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.sort_window = sort_window  # sort chunks by length among this many batches
+        self.near_duplicates = near_duplicates
+        self.pending_files: list[tuple[str, int]] = []
+        self.pending_chunks: list[tuple[str, Document]] = []
+        self.partial_files: dict[str, dict[int, list[Document]]] = {}  # files loaded in several parts, by part index
+        self.last_flush = time.monotonic()
+
+    def add(self, key: str, chunks: list[Document]) -> None:
+        """add the chunks of a file"""
+        if self.near_duplicates is not None:
+            chunks = self.near_duplicates.filter(key, chunks)
+        self.pending_files.append((key, len(chunks)))
+        self.pending_chunks += [(key, chunk) for chunk in chunks]
+
+    def add_part(self, key: str, part: int, n_parts: int, chunks: list[Document]) -> None:
+        """add the chunks of one part of a file. The file is added once all its parts are there, in order."""
+        parts = self.partial_files.setdefault(key, {})
+        parts[part] = chunks
+        if len(parts) == n_parts:
+            del self.partial_files[key]
+            self.add(key, [chunk for i in range(n_parts) for chunk in parts[i]])
+
+    def pop_batches(self, force: bool = False) -> Iterator[Batch]:
+        """pop the batches which are ready"""
+        expired = time.monotonic() - self.last_flush > self.timeout
+        if not force and not expired and len(self.pending_chunks) < self.max_size * self.sort_window:
+            return
+        self.pending_chunks.sort(key=lambda c: len(c[1].page_content))
+        n_full = len(self.pending_chunks) // self.max_size * self.max_size
+        flush_until = len(self.pending_chunks) if force or expired else n_full
+        chunks, self.pending_chunks = self.pending_chunks[:flush_until], self.pending_chunks[flush_until:]
+        files, self.pending_files = self.pending_files, []
+        self.last_flush = time.monotonic()
+        batches = [chunks[i : i + self.max_size] for i in range(0, len(chunks), self.max_size)] or [[]]
+        yield files, batches[0]
+        for batch in batches[1:]:
+            yield [], batch
+
+    def batches(self, split_documents: multiprocessing.pool.IMapIterator | Drained, n_tasks: int) -> Iterator[Batch]:
+        """consume (load task, chunks) from a pool's imap and yield batches"""
+        for _ in range(n_tasks):
+            while True:
+                try:
+                    (filepath, _, part, n_parts, _), chunks = split_documents.next(timeout=self.timeout)
+                    break
+                except multiprocessing.TimeoutError:
+                    yield from self.non_empty(self.pop_batches())
+            self.add_part(str(Path(filepath).resolve()), part, n_parts, chunks)
+            yield from self.non_empty(self.pop_batches())
+        yield from self.non_empty(self.pop_batches(force=True))
+
+    @staticmethod
+    def non_empty(batches: Iterator[Batch]) -> Iterator[Batch]:
+        """skip batches holding neither files nor chunks"""
+        return (batch for batch in batches if batch[0] or batch[1])
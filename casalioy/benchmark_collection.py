@@ -0,0 +1,138 @@
+"""report the memory and recall trade-off of the collection settings (quantization, on-disk storage, HNSW)
+usage: python casalioy/benchmark_collection.py [--chunks 20000] [--queries 100] [--k 10] [--model]
+Each setting gets its own collection, filled with the same synthetic chunks. Recall@k is measured against an exact search.
+Run it against a Qdrant server (QDRANT_URL): the local store ignores these settings and always searches exactly, in RAM.
+"""
+import argparse
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class Setting:
+    """collection settings to compare"""
+
+    name: str
+    quantization: str = "none"
+    always_ram: bool = True
+    on_disk_vectors: bool = False
+    on_disk_payload: bool = False
+    on_disk_index: bool = False
+    hnsw_m: int = 16
+    hnsw_ef_construct: int = 100
+    rescore: bool = True
+
+    def memory(self, n: int, dim: int, payload_bytes: int) -> tuple[float, float]:
+        """estimated RAM and disk use of the collection, in MB"""
+        vectors = n * dim * 4
+        quantized = {"none": 0, "scalar": n * dim, "product": n * dim * 4 // 16}[self.quantization]
+        graph = n * self.hnsw_m * 2 * 4  # links of the bottom layer, which dominates
+        parts = [(vectors, self.on_disk_vectors), (quantized, not self.always_ram), (graph, self.on_disk_index), (payload_bytes, self.on_disk_payload)]
+        ram = sum(size for size, on_disk in parts if not on_disk)
+        return ram / 1024**2, (sum(size for size, _ in parts) - ram) / 1024**2
+
+
+settings = [
+    Setting("float32 in RAM"),
+    Setting("float32 on disk", on_disk_vectors=True, on_disk_payload=True),
+    Setting("int8, rescored", quantization="scalar", on_disk_vectors=True, on_disk_payload=True),
+    Setting("int8, not rescored", quantization="scalar", on_disk_vectors=True, on_disk_payload=True, rescore=False),
+    Setting("int8, all on disk", quantization="scalar", always_ram=False, on_disk_vectors=True, on_disk_payload=True, on_disk_index=True),
+    Setting("PQ x16, rescored", quantization="product", on_disk_vectors=True, on_disk_payload=True),
+    Setting("int8, m=8", quantization="scalar", on_disk_vectors=True, on_disk_payload=True, hnsw_m=8, hnsw_ef_construct=64),
+    Setting("int8, m=32", quantization="scalar", on_disk_vectors=True, on_disk_payload=True, hnsw_m=32, hnsw_ef_construct=200),
+]
+
+
+def wait_indexed(client, collection: str, timeout: float = 600) -> None:
+    """wait for the server to finish optimizing the collection"""
+    from qdrant_client.http import models
+
+    deadline = time.monotonic() + timeout
+    while client.get_collection(collection).status != models.CollectionStatus.GREEN and time.monotonic() < deadline:
+        time.sleep(1)
+
+
+def run(args: argparse.Namespace) -> None:
+    """fill one collection per setting and search it"""
+    if not args.model:
+        os.environ["TEXT_EMBEDDINGS_MODEL_TYPE"], os.environ["TEXT_EMBEDDINGS_MODEL"] = "Hash", str(args.hash_size)
+    # imported after setting up the environment
+    from qdrant_client.http import models
+
+    from casalioy.load_env import get_embedding_model, qdrant_url
+    from casalioy.synthetic_corpus import SyntheticCorpus
+    from casalioy.vector_store import collection_config, get_search_params, open_client
+
+    corpus = SyntheticCorpus(args.seed)
+    texts = [" ".join(corpus.sentence() for _ in range(4)) for _ in range(args.chunks + args.queries)]
+    texts, queries = texts[: args.chunks], texts[args.chunks :]
+    encode = get_embedding_model()[1]
+    vectors, query_vectors = np.asarray(encode(texts)), np.asarray(encode(queries))
+    dim, payload_bytes = vectors.shape[1], sum(len(text.encode("utf-8")) for text in texts)
+
+    if not qdrant_url:
+        print("QDRANT_URL is not set: the local store ignores these settings, results are only indicative of the estimated memory\n")
+    with tempfile.TemporaryDirectory() as tmp:
+        client = open_client(tmp)
+        truth = None
+        print(f"{args.chunks} chunks of dimension {dim}, {args.queries} queries, recall@{args.k}")
+        print(f"{'setting':<22}{'RAM MB':>9}{'disk MB':>9}{'recall':>8}{'ms/query':>10}")
+        for setting in settings:
+            try:
+                config = collection_config(
+                    dim,
+                    quantization=setting.quantization,
+                    quantization_always_ram=setting.always_ram,
+                    on_disk_vectors=setting.on_disk_vectors,
+                    on_disk_payload=setting.on_disk_payload,
+                    on_disk_index=setting.on_disk_index,
+                    hnsw_m=setting.hnsw_m,
+                    hnsw_ef_construct=setting.hnsw_ef_construct,
+                )
+            except ValueError as e:
+                print(f"{setting.name:<22}skipped: {e}")
+                continue
+            collection = f"benchmark_{settings.index(setting)}"
+            client.recreate_collection(collection_name=collection, **config)
+            for i in range(0, args.chunks, 1000):
+                batch = range(i, min(i + 1000, args.chunks))
+                points = models.Batch.construct(
+                    ids=list(batch), vectors=vectors[batch.start : batch.stop].tolist(), payloads=[{"page_content": texts[j]} for j in batch]
+                )
+                client.upsert(collection_name=collection, points=points)
+            if qdrant_url:
+                wait_indexed(client, collection)
+
+            if truth is None:
+                exact = get_search_params(exact=True)
+                truth = [{p.id for p in client.search(collection, q.tolist(), search_params=exact, limit=args.k)} for q in query_vectors]
+            params = get_search_params(hnsw_ef=args.hnsw_ef, rescore=setting.rescore)
+            start = time.perf_counter()
+            found = [{p.id for p in client.search(collection, q.tolist(), search_params=params, limit=args.k)} for q in query_vectors]
+            latency = (time.perf_counter() - start) / len(query_vectors) * 1000
+            recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])
+            ram, disk = setting.memory(args.chunks, dim, payload_bytes)
+            print(f"{setting.name:<22}{ram:>9.1f}{disk:>9.1f}{recall:>8.3f}{latency:>10.2f}")
+            client.delete_collection(collection)
+
+
+def main() -> None:
+    """parse arguments and run"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=20_000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--hnsw-ef", type=int, help="candidates explored per search, server default if not set")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", action="store_true", help="use the configured embedding model instead of Hash embeddings")
+    parser.add_argument("--hash-size", type=int, default=384, help="vector size of the Hash embeddings")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""report the build time, search time and recall of the ivf backend, compared to an exact search
+usage: python casalioy/benchmark_index.py [--vectors 1000000] [--dim 384] [--queries 200] [--k 10] [--nprobe 0,16,64] [--model]
+The exact search scans every vector, as the local Qdrant store does. Recall@k is the share of its top k found by the index.
+By default the vectors are drawn around random centers, so that millions can be generated quickly; --model embeds synthetic chunks instead.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+
+def clustered_vectors(n: int, dim: int, rng: np.random.Generator, n_centers: int = 1000, spread: float = 0.5) -> np.ndarray:
+    """normalized vectors drawn around random centers, a stand-in for the embeddings of a corpus"""
+    centers = rng.normal(size=(n_centers, dim)).astype(np.float32)
+    vectors = np.empty((n, dim), dtype=np.float32)
+    for i in range(0, n, 65536):  # by blocks, to only hold the result in RAM
+        block = centers[rng.integers(0, n_centers, min(65536, n - i))]
+        block += spread * rng.standard_normal(size=block.shape, dtype=np.float32)
+        vectors[i : i + len(block)] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    return vectors
+
+
+def run(args: argparse.Namespace) -> None:
+    """fill an index batch by batch like ingestion, then search it"""
+    if not args.model:
+        os.environ["TEXT_EMBEDDINGS_MODEL_TYPE"], os.environ["TEXT_EMBEDDINGS_MODEL"] = "Hash", str(args.dim)
+    # imported after setting up the environment
+    from casalioy.ivf_index import IVFIndex, normalize
+    from casalioy.load_env import get_embedding_model
+    from casalioy.synthetic_corpus import SyntheticCorpus
+
+    rng = np.random.default_rng(args.seed)
+    if args.model:
+        corpus = SyntheticCorpus(args.seed)
+        embeddings = normalize(get_embedding_model()[1]([" ".join(corpus.sentence() for _ in range(4)) for _ in range(args.vectors + args.queries)]))
+        vectors, queries = embeddings[: args.vectors], embeddings[args.vectors :]
+    else:
+        vectors = clustered_vectors(args.vectors, args.dim, rng)
+        queries = normalize(vectors[rng.integers(0, args.vectors, args.queries)] + 0.3 * rng.normal(size=(args.queries, args.dim)))
+    ids = [f"{i:032x}" for i in range(len(vectors))]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = IVFIndex(IVFIndex.path_for(tmp, "benchmark"))
+        index.create(vectors.shape[1])
+        start = time.perf_counter()
+        for i in range(0, len(vectors), args.batch_size):
+            index.upsert(ids[i : i + args.batch_size], vectors[i : i + args.batch_size], None)
+        build = time.perf_counter() - start
+        print(f"{len(vectors)} vectors of dimension {vectors.shape[1]} in {len(index.centroids)} lists, built in {build:.1f}s, {args.queries} queries")
+
+        start = time.perf_counter()
+        truth = [set(np.argpartition(-(vectors @ query), args.k)[: args.k]) for query in queries]
+        exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+        print(f"{'search':<16}{'recall':>8}{'ms/query':>10}")
+        print(f"{'exact':<16}{1:>8.3f}{exact_ms:>10.2f}")
+        for nprobe in args.nprobe:
+            index.nprobe = nprobe
+            start = time.perf_counter()
+            found = [{int(hit.id, 16) for hit in index.search(query, args.k)} for query in queries]
+            ms = (time.perf_counter() - start) / len(queries) * 1000
+            recall = np.mean([len(f & t) / args.k for f, t in zip(found, truth)])
+            print(f"{f'ivf nprobe={index.n_probed}':<16}{recall:>8.3f}{ms:>10.2f}{'  (IVF_PROBE_FRACTION)' if not nprobe else ''}")
+        index.close()
+
+
+def main() -> None:
+    """parse arguments and run"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=1_000_000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--nprobe",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=[0, 16, 64],
+        help="comma-separated lists searched per query, 0 for IVF_PROBE_FRACTION of them",
+    )
+    parser.add_argument("--batch-size", type=int, default=10_000, help="vectors per upsert")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", action="store_true", help="embed synthetic chunks with the configured embedding model instead")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""benchmark ingestion on a deterministic synthetic corpus, and append the results to a file to compare them across commits
+usage: python casalioy/benchmark_ingest.py [--size small|medium|large] [--formats txt,pdf,...] [--model] [--output ingest_benchmarks.jsonl]
+By default, embeddings are computed with the deterministic Hash embeddings instead of the configured model, and the embedding cache is disabled.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+sizes = {  # name -> (files per format, characters per file)
+    "small": (10, 4_000),
+    "medium": (50, 32_000),
+    "large": (200, 128_000),
+}
+
+
+def git_commit() -> str:
+    """current commit, marked dirty if there are uncommitted changes"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, check=True).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def peak_rss_mb() -> dict[str, float]:
+    """peak resident memory of this process and of its largest finished child, in MB"""
+    to_mb = 1 / 1024 if platform.system() != "Darwin" else 1 / 1024**2  # kB on linux, bytes on mac
+    return {
+        "main": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * to_mb,
+        "largest_worker": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * to_mb,
+    }
+
+
+def run(args: argparse.Namespace) -> dict:
+    """generate the corpus and ingest it in a temporary db"""
+    n_files, size = (args.files, args.chars) if args.files else sizes[args.size]
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        os.environ["INGEST_STATS_FILE"] = str(tmp / "stats.json")
+        os.environ["INGEST_COUNT_LLM_TOKENS"] = "false"  # only the embedding model is measured
+        if not args.cache:
+            os.environ["INGEST_EMBEDDING_CACHE"] = "none"
+        if not args.model:
+            os.environ["TEXT_EMBEDDINGS_MODEL_TYPE"], os.environ["TEXT_EMBEDDINGS_MODEL"] = "Hash", str(args.hash_size)
+        # imported after setting up the environment, which the worker processes inherit
+        from ingest import Ingester
+        from load_env import chunk_overlap, chunk_size, text_embeddings_model, text_embeddings_model_type
+
+        from casalioy.synthetic_corpus import SyntheticCorpus
+
+        files = SyntheticCorpus(args.seed).generate(tmp / "corpus", args.formats, n_files, size)
+        corpus_bytes = sum(f.stat().st_size for f in files)
+        print(f"Generated {len(files)} files, {corpus_bytes / 1024**2:.1f} MB")
+
+        start = time.perf_counter()
+        Ingester(str(tmp / "db"), collection="benchmark").ingest_from_directory(str(tmp / "corpus"), chunk_size, chunk_overlap)
+        wall_time = time.perf_counter() - start
+
+        with open(tmp / "stats.json", encoding="utf8") as f:
+            stats = json.load(f)
+
+    return {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "corpus": {"seed": args.seed, "formats": args.formats, "files": len(files), "chars_per_file": size, "bytes": corpus_bytes},
+        "settings": {
+            "embeddings": f"{text_embeddings_model_type}:{text_embeddings_model}",
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+            **{k: v for k, v in os.environ.items() if k.startswith("INGEST_")},
+        },
+        "wall_time_s": wall_time,
+        "files_per_s": len(files) / wall_time,
+        "bytes_per_s": corpus_bytes / wall_time,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stats["stages"],
+        "queues": stats["queues"],
+        "embedding_batch_sizes": stats["embedding_batch_sizes"],
+    }
+
+
+def compare(output: str) -> None:
+    """print the results of the file, one line per run"""
+    with open(output, encoding="utf8") as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    print(f"{'commit':<16}{'date':<21}{'files':>7}{'MB':>8}{'wall s':>9}{'files/s':>9}{'MB/s':>8}{'RSS MB':>8}  embeddings")
+    for r in results:
+        rss = max(r["peak_rss_mb"].values())
+        mb = r["corpus"]["bytes"] / 1024**2
+        print(
+            f"{r['commit']:<16}{r['date']:<21}{r['corpus']['files']:>7}{mb:>8.1f}{r['wall_time_s']:>9.2f}{r['files_per_s']:>9.1f}"
+            f"{r['bytes_per_s'] / 1024**2:>8.2f}{rss:>8.0f}  {r['settings']['embeddings']}"
+        )
+
+
+def main() -> None:
+    """parse arguments and run"""
+    from casalioy.synthetic_corpus import SyntheticCorpus
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=sizes, default="small", help="preset corpus size")
+    parser.add_argument("--files", type=int, help="files per format, overrides --size")
+    parser.add_argument("--chars", type=int, default=16_000, help="characters per file, with --files")
+    parser.add_argument("--formats", type=lambda s: s.split(","), default=list(SyntheticCorpus().writers), help="comma-separated extensions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", action="store_true", help="use the configured embedding model instead of Hash embeddings")
+    parser.add_argument("--hash-size", type=int, default=384, help="vector size of the Hash embeddings")
+    parser.add_argument("--cache", action="store_true", help="keep the embedding cache enabled")
+    parser.add_argument("--output", default="ingest_benchmarks.jsonl", help="file the results are appended to")
+    parser.add_argument("--compare", action="store_true", help="only print the results already in the output file")
+    args = parser.parse_args()
+
+    if not args.compare:
+        result = run(args)
+        with open(args.output, "a", encoding="utf8") as f:
+            f.write(json.dumps(result) + "\n")
+    compare(args.output)
+
+
+if __name__ == "__main__":
+    main()
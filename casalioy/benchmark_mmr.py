@@ -0,0 +1,96 @@
+"""check that mmr_select selects the same documents as langchain's maximal_marginal_relevance, and compare their speed
+usage: python casalioy/benchmark_mmr.py [--trials 200] [--fetch-k 100] [--k 10] [--dim 384]
+Edge cases (k larger than the number of candidates, duplicate and zero vectors, lambda_mult 0 and 1) are checked first and must
+select exactly the same vectors. Then candidates are random vectors, with repeated and zero vectors mixed in to exercise ties:
+the script fails if the selections differ, unless the two candidates picked at the first difference tie up to floating-point rounding.
+"""
+import argparse
+import time
+
+import numpy as np
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+
+def candidates(rng: np.random.Generator, fetch_k: int, dim: int) -> list[list[float]]:
+    """vectors as returned by a search, with some duplicates and a zero vector"""
+    vectors = rng.normal(size=(fetch_k, dim))
+    vectors[rng.integers(0, fetch_k, fetch_k // 10)] = vectors[rng.integers(0, fetch_k, fetch_k // 10)]
+    vectors[rng.integers(0, fetch_k)] = 0
+    return vectors.tolist()
+
+
+def mmr_score(query: np.ndarray, vectors: np.ndarray, selected: list[int], candidate: int, lambda_mult: float) -> float:
+    """marginal relevance of a candidate given the vectors already selected"""
+    unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-300)
+    relevance = unit[candidate] @ query / np.linalg.norm(query)
+    return lambda_mult * relevance - (1 - lambda_mult) * max(unit[candidate] @ unit[i] for i in selected)
+
+
+def check_edge_cases(rng: np.random.Generator, dim: int = 8) -> int:
+    """compare the selections of both implementations on small edge cases, return how many were checked"""
+    from casalioy.vector_store import mmr_select
+
+    vectors = rng.normal(size=(5, dim))
+    cases = {
+        "k > n": vectors,
+        "duplicates": np.concatenate([vectors, vectors[:2], vectors[:1]]),
+        "zero vector": np.concatenate([vectors, np.zeros((1, dim))]),
+        "single candidate": vectors[:1],
+    }
+    n_checked = 0
+    for name, candidates in cases.items():
+        query = rng.normal(size=dim)
+        for lambda_mult in (0.0, 0.5, 1.0):
+            for k in (0, 1, 3, len(candidates), len(candidates) + 3):
+                expected = maximal_marginal_relevance(query, candidates.tolist(), k=k, lambda_mult=lambda_mult)
+                selected = mmr_select(query.tolist(), candidates.tolist(), k, lambda_mult)
+                if selected != expected:
+                    raise AssertionError(f"{name}, k={k}, lambda_mult={lambda_mult}: selected {selected}, langchain selected {expected}")
+                n_checked += 1
+    return n_checked
+
+
+def run(args: argparse.Namespace) -> None:
+    """check the edge cases, then select from random candidates with both implementations"""
+    from casalioy.vector_store import mmr_select
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{check_edge_cases(rng)} edge cases: identical selections")
+    timings, ties = {"langchain": 0.0, "mmr_select": 0.0}, 0
+    for trial in range(args.trials):
+        vectors, query = candidates(rng, args.fetch_k, args.dim), rng.normal(size=args.dim).tolist()
+        lambda_mult = [0.0, 0.25, 0.5, 0.75, 1.0][trial % 5]
+        start = time.perf_counter()
+        expected = maximal_marginal_relevance(np.array(query), vectors, k=args.k, lambda_mult=lambda_mult)
+        timings["langchain"] += time.perf_counter() - start
+        start = time.perf_counter()
+        selected = mmr_select(query, vectors, args.k, lambda_mult)
+        timings["mmr_select"] += time.perf_counter() - start
+        if selected != expected:
+            step = next(i for i, (a, b) in enumerate(zip(selected, expected)) if a != b)
+            scores = [mmr_score(np.array(query), np.array(vectors), selected[:step], i, lambda_mult) for i in (selected[step], expected[step])]
+            if step == 0 or abs(scores[0] - scores[1]) > 1e-9:
+                raise AssertionError(f"Trial {trial}, lambda_mult={lambda_mult}: selected {selected}, langchain selected {expected}")
+            ties += 1
+
+    print(
+        f"{args.trials} trials selecting {args.k} of {args.fetch_k} vectors of dimension {args.dim}: "
+        f"{args.trials - ties} identical selections, {ties} differing only after a tie"
+    )
+    for name, seconds in timings.items():
+        print(f"{name:<12}{seconds / args.trials * 1000:>8.2f} ms/query")
+
+
+def main() -> None:
+    """parse arguments and run"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=200)
+    parser.add_argument("--fetch-k", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--seed", type=int, default=0)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""report the recall, index size and search time of reduced embeddings, compared to the full ones
+usage: python casalioy/benchmark_reduction.py [--chunks 20000] [--queries 200] [--k 10] [--dims 32,64,128,256] [--model]
+Recall@k is the share of the exact top k chunks, searched with the full embeddings, which are found with the reduced ones.
+Truncation is only meaningful for models trained for it (Matryoshka embeddings).
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+
+def top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> tuple[np.ndarray, float]:
+    """indices of the k most similar vectors to each query by cosine similarity, and the search time per query in ms"""
+    start = time.perf_counter()
+    scores = queries @ vectors.T
+    found = np.argpartition(-scores, k, axis=1)[:, :k]
+    return found, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def run(args: argparse.Namespace) -> None:
+    """embed a synthetic corpus, then search it with each reduction"""
+    if not args.model:
+        os.environ["TEXT_EMBEDDINGS_MODEL_TYPE"], os.environ["TEXT_EMBEDDINGS_MODEL"] = "Hash", str(args.hash_size)
+    # imported after setting up the environment
+    from casalioy.load_env import get_embedding_model, ingest_reduce_sample
+    from casalioy.projection import Projection
+    from casalioy.synthetic_corpus import SyntheticCorpus
+
+    corpus = SyntheticCorpus(args.seed)
+    texts = [" ".join(corpus.sentence() for _ in range(4)) for _ in range(args.chunks + args.queries)]
+    encode = get_embedding_model()[1]
+    embeddings = np.asarray(encode(texts), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    vectors, queries = embeddings[: args.chunks], embeddings[args.chunks :]
+    truth, full_ms = top_k(vectors, queries, args.k)
+
+    print(f"{args.chunks} chunks of dimension {vectors.shape[1]}, {args.queries} queries, recall@{args.k}, PCA fitted on {ingest_reduce_sample} chunks")
+    print(f"{'reduction':<16}{'dim':>6}{'index MB':>10}{'recall':>8}{'ms/query':>10}")
+    print(f"{'none':<16}{vectors.shape[1]:>6}{vectors.nbytes / 1024**2:>10.1f}{1:>8.3f}{full_ms:>10.2f}")
+    for kind in ("pca", "truncate"):
+        for dim in args.dims:
+            if dim >= vectors.shape[1]:
+                continue
+            projection = Projection.fit(kind, dim, vectors[: max(ingest_reduce_sample, dim)])
+            reduced, reduced_queries = projection(vectors), projection(queries)
+            found, ms = top_k(reduced, reduced_queries, args.k)
+            recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+            print(f"{kind:<16}{projection.dim:>6}{reduced.nbytes / 1024**2:>10.1f}{recall:>8.3f}{ms:>10.2f}")
+
+
+def main() -> None:
+    """parse arguments and run"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=20_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dims", type=lambda s: [int(d) for d in s.split(",")], default=[32, 64, 128, 256], help="comma-separated target dimensions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", action="store_true", help="use the configured embedding model instead of Hash embeddings")
+    parser.add_argument("--hash-size", type=int, default=384, help="vector size of the Hash embeddings")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""report the recall, forwarded tokens and latency of reranking the candidates with a cross-encoder, compared to MMR and similarity
+usage: python casalioy/benchmark_rerank.py questions.jsonl [--fetch-k 100] [--k 1,2,4,8] [--batch-size 32] [--threads 0]
+Runs on the ingested collection (PERSIST_DIRECTORY), with RERANK_MODEL unless --model is given. Each line of the questions file is
+{"question": ..., "answer": ...}: a chunk is relevant if it contains the answer, and recall@k is the share of questions for which
+one of the k forwarded chunks is relevant. Tokens are those of the forwarded chunks, which the LLM has to evaluate for each question.
+"""
+import argparse
+import json
+import time
+
+
+def run(args: argparse.Namespace) -> None:
+    """search each question, then rank its candidates each way"""
+    from casalioy.docstore import DocStore
+    from casalioy.load_env import (
+        chunk_docstore,
+        get_embedding_model,
+        get_token_length,
+        persist_directory,
+        rerank_batch_size,
+        rerank_model,
+        rerank_n_threads,
+    )
+    from casalioy.projection import ProjectedEmbeddings, Projection
+    from casalioy.reranker import Reranker
+    from casalioy.vector_store import IndexStore, mmr_select, open_index
+
+    if not (args.model or rerank_model):
+        raise ValueError("No cross-encoder: set RERANK_MODEL or pass --model")
+    with open(args.questions, encoding="utf-8") as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+    embeddings = get_embedding_model()[0]
+    if projection := Projection.load(Projection.path_for(persist_directory, args.collection)):
+        embeddings = ProjectedEmbeddings(embeddings, projection)
+    docstore = DocStore(DocStore.path_for(persist_directory, args.collection)) if chunk_docstore else None
+    index = open_index(persist_directory, args.collection, read_only=True)
+    store = IndexStore(index, embeddings, docstore)
+    reranker = Reranker.load(args.model or rerank_model, args.batch_size or rerank_batch_size, args.threads or rerank_n_threads)
+    token_length = get_token_length(args.tokenizer)
+
+    rankings: dict[str, list[list[int]]] = {"similarity": [], "mmr": [], "rerank": []}
+    relevant, tokens, rerank_seconds = [], [], 0.0
+    for item in questions:
+        query_vector = embeddings.embed_query(item["question"])
+        results = store.search(query_vector, args.fetch_k, with_vectors=True)
+        candidates = store.documents(results)
+        relevant.append([item["answer"].lower() in document.page_content.lower() for document in candidates])
+        tokens.append([token_length(document.page_content) for document in candidates])
+        rankings["similarity"].append(list(range(len(candidates))))
+        rankings["mmr"].append(mmr_select(query_vector, [result.vector for result in results], max(args.k)))
+        start = time.perf_counter()
+        scores = reranker.scores(item["question"], candidates)
+        rerank_seconds += time.perf_counter() - start
+        rankings["rerank"].append(sorted(range(len(candidates)), key=lambda i: -scores[i]))
+    index.close()
+
+    ceiling = sum(any(r) for r in relevant) / len(questions)
+    print(f"{len(questions)} questions, {args.fetch_k} candidates each, containing the answer for {ceiling:.1%} of them")
+    print(f"reranking: {rerank_seconds / len(questions) * 1000:.1f} ms/question with batches of {reranker.batch_size}")
+    print(f"{'ranking':<12}{'k':>4}{'recall':>8}{'tokens':>8}")
+    for k in args.k:
+        for name, ranking in rankings.items():
+            recall = sum(any(r[i] for i in order[:k]) for r, order in zip(relevant, ranking)) / len(questions)
+            n_tokens = sum(sum(t[i] for i in order[:k]) for t, order in zip(tokens, ranking)) / len(questions)
+            print(f"{name:<12}{k:>4}{recall:>8.3f}{n_tokens:>8.0f}")
+
+
+def main() -> None:
+    """parse arguments and run"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", help="JSON lines of questions and the answers that relevant chunks contain")
+    parser.add_argument("--collection", default="test")
+    parser.add_argument("--fetch-k", type=int, default=100, help="candidates retrieved by similarity for each question")
+    parser.add_argument("--k", type=lambda s: [int(n) for n in s.split(",")], default=[1, 2, 4, 8], help="comma-separated numbers of forwarded chunks")
+    parser.add_argument("--model", help="cross-encoder, RERANK_MODEL by default")
+    parser.add_argument("--batch-size", type=int, help="pairs per forward pass, RERANK_BATCH_SIZE by default")
+    parser.add_argument("--threads", type=int, help="torch threads, RERANK_N_THREADS by default")
+    parser.add_argument("--tokenizer", choices=["llm", "embedding"], default="llm", help="tokenizer counting the forwarded tokens")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""compare the speed and the chunks of the text splitters on a deterministic synthetic corpus
+usage: python casalioy/benchmark_splitter.py [--chars 2000000] [--tokenizer embedding|llm]
+"""
+import argparse
+import statistics
+import time
+from typing import Callable
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
+from load_env import chunk_overlap, chunk_size, get_token_length
+
+from casalioy.synthetic_corpus import SyntheticCorpus
+from casalioy.text_splitter import FastTextSplitter
+
+
+def measure(name: str, splitter: TextSplitter, texts: list[str], length: Callable[[str], int] = len) -> None:
+    """split all texts and print the time taken and chunk sizes"""
+    start = time.perf_counter()
+    chunks = [chunk for text in texts for chunk in splitter.split_text(text)]
+    elapsed = time.perf_counter() - start
+    sizes = [length(chunk) for chunk in chunks]
+    n_chars = sum(len(text) for text in texts)
+    print(
+        f"{name:<32}{elapsed:>9.3f}{n_chars / elapsed / 1024**2:>9.2f}{len(chunks):>9}"
+        f"{statistics.mean(sizes):>9.1f}{max(sizes):>7}{sum(s > splitter._chunk_size for s in sizes):>9}"
+    )
+
+
+def main() -> None:
+    """parse arguments and run"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chars", type=int, default=2_000_000, help="total characters to split")
+    parser.add_argument("--docs", type=int, default=20, help="number of documents")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tokenizer", choices=("embedding", "llm"), help="also benchmark chunk sizes in tokens of that model")
+    args = parser.parse_args()
+
+    corpus = SyntheticCorpus(args.seed)
+    texts = ["\n\n".join(corpus.paragraphs(args.chars // args.docs)) for _ in range(args.docs)]
+    print(f"chunk_size={chunk_size} chunk_overlap={chunk_overlap}, {args.docs} documents, {sum(map(len, texts))} characters")
+    print(f"{'splitter':<32}{'seconds':>9}{'MB/s':>9}{'chunks':>9}{'mean':>9}{'max':>7}{'oversize':>9}")
+    measure("recursive", RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap), texts)
+    measure("fast", FastTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap), texts)
+    if args.tokenizer:
+        token_length = get_token_length(args.tokenizer)
+        recursive = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=token_length)
+        measure(f"recursive ({args.tokenizer} tokens)", recursive, texts, token_length)
+        measure(f"fast ({args.tokenizer} tokens)", FastTextSplitter(chunk_size, chunk_overlap, token_length), texts, token_length)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""near-duplicate chunk detection with MinHash signatures and locality-sensitive hashing"""
+import re
+import zlib
+from collections import defaultdict
+from typing import Callable
+
+import numpy as np
+from langchain.docstore.document import Document
+
+
+class NearDuplicates:
+    """clusters chunks whose word 3-gram sets have an estimated Jaccard similarity of at least threshold.
+    The first chunk of a cluster represents it and is embedded; the others are dropped, and their sources are added to
+    the representative's metadata ("duplicate_sources"). The index is kept in memory, for the lifetime of the ingester.
+    Signatures are split into bands: chunks sharing a band are candidates, which are then checked on the whole signature.
+    """
+
+    prime = 2**31 - 1  # a * shingle hash then fits in 64 bits
+    word_pattern = re.compile(r"\w+")
+
+    def __init__(self, threshold: float, chunk_id: Callable[[str], str], num_perm: int = 128, shingle_size: int = 3, seed: int = 0):
+        self.threshold = threshold
+        self.chunk_id = chunk_id
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, self.prime, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, self.prime, num_perm, dtype=np.uint64)
+        self.n_bands, self.rows = self.lsh_params(threshold, num_perm)
+        self.bands: list[dict[bytes, list[str]]] = [defaultdict(list) for _ in range(self.n_bands)]
+        self.signatures: dict[str, np.ndarray] = {}  # representative ID -> signature
+        self.metadata: dict[str, dict] = {}  # representative ID -> its metadata, with the sources of its duplicates
+        self.duplicates: dict[str, list[str]] = defaultdict(list)  # file key -> IDs of the representatives of its dropped chunks
+        self.updated: set[str] = set()  # representatives which got new duplicate sources since the last pop_updates
+        self.n_dropped = 0
+
+    @staticmethod
+    def lsh_params(threshold: float, num_perm: int) -> tuple[int, int]:
+        """number of bands and rows per band whose S-curve (1/bands)^(1/rows) is the closest to the threshold"""
+        candidates = [(num_perm // rows, rows) for rows in range(1, num_perm + 1)]
+        return min(candidates, key=lambda c: abs((1 / c[0]) ** (1 / c[1]) - threshold))
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash signature of the word shingles of a text"""
+        words = self.word_pattern.findall(text.lower())
+        n = max(len(words) - self.shingle_size + 1, 1)
+        hashes = np.array([zlib.crc32(" ".join(words[i : i + self.shingle_size]).encode("utf-8")) for i in range(n)], dtype=np.uint64) % self.prime
+        return ((np.outer(hashes, self.a) + self.b) % self.prime).min(axis=0)
+
+    def find(self, signature: np.ndarray) -> str | None:
+        """the representative of a near-duplicate of this signature, if any"""
+        seen = set()
+        for band, start in zip(self.bands, range(0, self.n_bands * self.rows, self.rows)):
+            for candidate in band.get(signature[start : start + self.rows].tobytes(), []):
+                if candidate not in seen:
+                    seen.add(candidate)
+                    if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                        return candidate
+        return None
+
+    def add(self, chunk_id: str, signature: np.ndarray, metadata: dict) -> None:
+        """index a new representative"""
+        self.signatures[chunk_id], self.metadata[chunk_id] = signature, metadata
+        for band, start in zip(self.bands, range(0, self.n_bands * self.rows, self.rows)):
+            band[signature[start : start + self.rows].tobytes()].append(chunk_id)
+
+    def forget(self, chunk_ids: list[str]) -> None:
+        """remove representatives, e.g. when their chunks are deleted from the store"""
+        for chunk_id in chunk_ids:
+            if (signature := self.signatures.pop(chunk_id, None)) is None:
+                continue
+            del self.metadata[chunk_id]
+            self.updated.discard(chunk_id)
+            for band, start in zip(self.bands, range(0, self.n_bands * self.rows, self.rows)):
+                band[signature[start : start + self.rows].tobytes()].remove(chunk_id)
+
+    def filter(self, key: str, chunks: list[Document]) -> list[Document]:
+        """the chunks of a file which aren't near-duplicates of a chunk seen before"""
+        kept = []
+        for chunk in chunks:
+            chunk_id, signature = self.chunk_id(chunk.page_content), self.signature(chunk.page_content)
+            representative = chunk_id if chunk_id in self.signatures else self.find(signature)
+            if representative is None:
+                self.add(chunk_id, signature, dict(chunk.metadata))
+                kept.append(chunk)
+                continue
+            self.duplicates[key].append(representative)
+            self.n_dropped += 1
+            source, metadata = chunk.metadata.get("source"), self.metadata[representative]
+            if source != metadata.get("source") and source not in metadata.setdefault("duplicate_sources", []):
+                metadata["duplicate_sources"].append(source)
+                self.updated.add(representative)
+        return kept
+
+    def pop_updates(self) -> dict[str, dict]:
+        """metadata of the representatives which got new duplicate sources"""
+        updates = {chunk_id: self.metadata[chunk_id] for chunk_id in self.updated}
+        self.updated = set()
+        return updates
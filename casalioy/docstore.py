@@ -0,0 +1,57 @@
+"""chunk texts and metadata kept next to the vector store instead of in its payloads"""
+import json
+import zlib
+
+from langchain.docstore.document import Document
+
+from casalioy.sqlite_utils import connect, in_clauses
+from casalioy.utils import collection_path
+
+
+class DocStore:
+    """compressed chunk texts and metadata keyed by point ID
+    Backed by SQLite with memory-mapped reads: the vector store then holds only IDs and vectors, and a search only reads
+    the text of the chunks it returns, instead of deserializing the payload of every candidate.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, text BLOB, metadata TEXT)")
+
+    @staticmethod
+    def path_for(db_dir: str, collection: str) -> str:
+        """where the docstore of a collection is kept"""
+        return str(collection_path(db_dir, f"docstore.{collection}.sqlite"))
+
+    def put(self, ids: list[str], documents: list[Document]) -> None:
+        """add or replace chunks"""
+        rows = [(key, zlib.compress(doc.page_content.encode("utf-8"), 1), json.dumps(doc.metadata)) for key, doc in zip(ids, documents)]
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?)", rows)
+
+    def update_metadata(self, metadatas: dict[str, dict]) -> None:
+        """replace the metadata of chunks"""
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("UPDATE chunks SET metadata=? WHERE id=?", [(json.dumps(metadata), key) for key, metadata in metadatas.items()])
+
+    def get(self, ids: list[str]) -> dict[str, Document]:
+        """the chunks found among ids"""
+        found = {}
+        for part, placeholders in in_clauses(ids):
+            rows = self.db.execute(f"SELECT id, text, metadata FROM chunks WHERE id IN ({placeholders})", part)
+            found |= {key: Document(page_content=zlib.decompress(text).decode("utf-8"), metadata=json.loads(metadata)) for key, text, metadata in rows}
+        return found
+
+    def delete(self, ids: list[str]) -> None:
+        """remove chunks"""
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            for part, placeholders in in_clauses(ids):
+                self.db.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", part)
+
+    def close(self) -> None:
+        """release the connection"""
+        self.db.close()
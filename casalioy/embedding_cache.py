@@ -0,0 +1,56 @@
+"""persistent cache of chunk embeddings, shared across runs and collections"""
+import time
+
+import numpy as np
+
+from casalioy.sqlite_utils import connect, in_clauses
+
+
+class EmbeddingCache:
+    """on-disk cache of embeddings keyed by (embedding model, chunk hash)
+    Backed by SQLite with memory-mapped reads, so it can be shared by several worker processes.
+    Holds at most max_size embeddings, the least recently used ones are evicted first.
+    """
+
+    def __init__(self, path: str, model_id: str, max_size: int):
+        self.path = path
+        self.model_id = model_id
+        self.max_size = max_size
+        self.db = connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, hash TEXT, vector BLOB, last_used INTEGER, PRIMARY KEY (model, hash))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def get(self, hashes: list[str]) -> dict[str, np.ndarray]:
+        """the cached embeddings among hashes, and mark them as used"""
+        found = {}
+        for part, placeholders in in_clauses(hashes):
+            rows = self.db.execute(f"SELECT hash, vector FROM embeddings WHERE model=? AND hash IN ({placeholders})", [self.model_id, *part])
+            found |= {h: np.frombuffer(v, dtype=np.float32) for h, v in rows}
+            self.db.execute(f"UPDATE embeddings SET last_used=? WHERE model=? AND hash IN ({placeholders})", [time.time_ns(), self.model_id, *part])
+        self.count(hits=len(found), misses=len(set(hashes)) - len(found))
+        return found
+
+    def put(self, hashes: list[str], embeddings: np.ndarray) -> None:
+        """add embeddings, evict the least recently used ones beyond max_size"""
+        now = time.time_ns()
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+                [(self.model_id, h, np.asarray(e, dtype=np.float32).tobytes(), now) for h, e in zip(hashes, embeddings)],
+            )
+            n_evict = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_size
+            if n_evict > 0:
+                self.db.execute("DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (n_evict,))
+                self.count(evictions=n_evict)
+
+    def count(self, **counters: int) -> None:
+        """increment persistent counters"""
+        self.db.executemany(
+            "INSERT INTO stats VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value=value+excluded.value", [(k, v) for k, v in counters.items() if v]
+        )
+
+    def stats(self) -> dict[str, int]:
+        """cumulated hits, misses and evictions"""
+        return {"hits": 0, "misses": 0, "evictions": 0} | dict(self.db.execute("SELECT name, value FROM stats").fetchall())
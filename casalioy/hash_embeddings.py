@@ -0,0 +1,35 @@
+"""deterministic embeddings without a model, for benchmarks and tests"""
+import re
+from hashlib import blake2b
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+class HashEmbeddings(Embeddings):
+    """bag-of-words feature hashing: each word adds +-1 to a bucket of the vector, which is then normalized.
+    Much faster than a real model and fully deterministic, while still giving similar vectors to texts sharing words.
+    """
+
+    word_pattern = re.compile(r"\w+")
+
+    def __init__(self, size: int = 384):
+        self.size = size
+
+    def encode(self, texts: str | list[str]) -> np.ndarray:
+        """embed a text or a list of texts, same interface as SentenceTransformer.encode"""
+        if isinstance(texts, str):
+            return self.encode([texts])[0]
+        embeddings = np.zeros((len(texts), self.size), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in self.word_pattern.findall(text.lower()):
+                h = int.from_bytes(blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+                embeddings[i, h % self.size] += 1 if h >> 63 else -1
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms == 0, 1, norms)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.encode(text).tolist()
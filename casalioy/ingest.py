@@ -1,14 +1,23 @@
 """ingest documents into vector database using embedding"""
 
 import contextlib
+import cProfile
+import functools
+import io
 import multiprocessing
+import multiprocessing.util
 import os
+import queue
 import shutil
 import sys
+import threading
+import time
+from collections import defaultdict
 from hashlib import md5
 from pathlib import Path
-from typing import Any, Callable
+from typing import Any, Callable, Iterator
 
+import numpy as np
 from langchain.docstore.document import Document
 from langchain.document_loaders import (
     CSVLoader,
@@ -18,28 +27,114 @@ from langchain.document_loaders import (
     UnstructuredEmailLoader,
     UnstructuredEPubLoader,
     UnstructuredHTMLLoader,
-    UnstructuredPowerPointLoader,
     UnstructuredMarkdownLoader,
+    UnstructuredPowerPointLoader,
     UnstructuredWordDocumentLoader,
 )
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from load_env import chunk_overlap, chunk_size, documents_directory, get_embedding_model, ingest_n_threads, persist_directory
+from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
+from load_env import (
+    chunk_docstore,
+    chunk_overlap,
+    chunk_size,
+    documents_directory,
+    get_embedding_model,
+    get_token_length,
+    ingest_archive_members_per_task,
+    ingest_chunk_tokenizer,
+    ingest_count_llm_tokens,
+    ingest_dedup_threshold,
+    ingest_embed_batch_size,
+    ingest_embed_batch_timeout,
+    ingest_embedding_cache,
+    ingest_embedding_cache_size,
+    ingest_max_queued_batches,
+    ingest_max_queued_files,
+    ingest_n_embedders,
+    ingest_n_loaders,
+    ingest_pdf_pages_per_task,
+    ingest_reduce_dim,
+    ingest_reduce_method,
+    ingest_reduce_sample,
+    ingest_splitter,
+    ingest_stats_file,
+    ingest_stats_interval,
+    ingest_watch_debounce,
+    ingest_watch_interval,
+    llm_tokenizer,
+    model_type,
+    persist_directory,
+    qdrant_url,
+    text_embeddings_model,
+    text_embeddings_model_type,
+    vector_backend,
+)
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
 from prompt_toolkit import PromptSession
 from prompt_toolkit.shortcuts import ProgressBar
-from qdrant_client import QdrantClient, models
 
+from casalioy.archives import is_archive, list_members, load_archive
+from casalioy.batcher import Batch, ChunkBatcher, EmbeddedBatch, LoadTask
+from casalioy.dedup import NearDuplicates
+from casalioy.docstore import DocStore
+from casalioy.embedding_cache import EmbeddingCache
+from casalioy.manifest import IngestManifest
+from casalioy.pipeline import Backpressure
+from casalioy.projection import Projection
+from casalioy.stats import IngestStats
+from casalioy.text_splitter import FastTextSplitter
 from casalioy.utils import print_HTML, prompt_HTML
+from casalioy.vector_store import StoreBusyError, VectorIndex, open_index
+from casalioy.watcher import DirectoryWatcher
 
 with contextlib.suppress(RuntimeError):
     multiprocessing.set_start_method("spawn", force=True)
 
 
+class PDFPageLoader:
+    """loads a PDF as one document per page, with its number as "page" metadata, whether the whole file is loaded at once
+    or by page ranges: the chunks of a page then cite it the same way, whatever the size of the file"""
+
+    def __init__(self, file_path: str, pages: range | None = None):
+        self.file_path = file_path
+        self.pages = pages  # all of them by default
+
+    @staticmethod
+    def page_count(filepath: Path) -> int:
+        """number of pages of a PDF, read from its catalog without parsing the pages. 0 if it can't be read."""
+        try:
+            with open(filepath, "rb") as f:
+                return int(resolve1(PDFDocument(PDFParser(f)).catalog["Pages"])["Count"])
+        except Exception:  # left to PDFMinerLoader to report
+            return 0
+
+    def load(self) -> list[Document]:
+        """extract the pages, or the whole text with PDFMinerLoader if the page count can't be read"""
+        pages = self.pages if self.pages is not None else range(self.page_count(Path(self.file_path)))
+        if not pages:
+            return PDFMinerLoader(self.file_path).load()
+        documents, resource_manager = [], PDFResourceManager()
+        with open(self.file_path, "rb") as f:
+            for page_number, page in zip(pages, PDFPage.get_pages(f, pagenos=set(pages))):
+                text = io.StringIO()
+                device = TextConverter(resource_manager, text, laparams=LAParams())
+                PDFPageInterpreter(resource_manager, device).process_page(page)
+                device.close()
+                documents.append(Document(page_content=text.getvalue(), metadata={"source": self.file_path, "page": page_number + 1}))
+        return documents
+
+
 class Ingester:
     """ingest documents"""
 
     file_loaders = {  # extension -> loader
         "txt": lambda path: TextLoader(path, encoding="utf8"),
-        "pdf": PDFMinerLoader,
+        "pdf": PDFPageLoader,
         "csv": CSVLoader,
         "epub": UnstructuredEPubLoader,
         "html": UnstructuredHTMLLoader,
@@ -53,19 +148,62 @@ class Ingester:
     }
 
     def __init__(self, db_dir: str, collection: str = "test", verbose=False):
-        self.n_threads = ingest_n_threads
+        self.n_loaders = ingest_n_loaders
+        self.n_embedders = ingest_n_embedders
+        self.embed_batch_size = ingest_embed_batch_size
+        self.embed_batch_timeout = ingest_embed_batch_timeout
+        self.max_queued_files = ingest_max_queued_files
+        self.max_queued_batches = ingest_max_queued_batches
+        self.pdf_pages_per_task = ingest_pdf_pages_per_task
+        self.archive_members_per_task = ingest_archive_members_per_task
         self.encode_fun = None
+        self.embedding_cache = None
         self.text_splitter = None
         self.db_dir = db_dir
         self.collection = collection
         self.verbose = verbose
         self.awaiting_storage = []
+        self.awaiting_record = []  # files whose chunks are all in awaiting_storage
         self.store_N_batch = 1000
+        self.manifest = None
+        self._index = None
+        self._docstore = None
+        self.pools = None
+        self.projection = None
+        self.near_duplicates = NearDuplicates(ingest_dedup_threshold, self.chunk_id) if ingest_dedup_threshold else None
+        self.collection_exists = False
+        self.store_queue = None  # set while the background writer runs
+        self.writer_error = None
+        self.stats = None  # set while ingesting
+        self.failed_files = set()  # keys of the files which failed to load during the current run, not recorded in the manifest
+        self.profile = False  # profile the worker processes
 
-    def load_one_doc(self, filepath: Path) -> list[Document]:
-        """load one document"""
+    @functools.cached_property
+    def llm_token_length(self) -> Callable[[str], int] | None:
+        """counts the tokens of chunks for the LLM, loaded on first use by each loader process. None if disabled or if the tokenizer can't be loaded."""
+        if not ingest_count_llm_tokens or model_type != "LlamaCpp":
+            return None
+        try:
+            return get_token_length("llm")
+        except (ImportError, ValueError, AssertionError) as e:  # llama_cpp not installed, or no valid MODEL_PATH
+            print_HTML("<w>Not counting the LLM tokens of chunks, its tokenizer can't be loaded: {e}</w>", e=e)
+            return None
+
+    @staticmethod
+    def open_embedding_cache() -> EmbeddingCache | None:
+        """the embedding cache, if enabled"""
+        if not ingest_embedding_cache:
+            return None
+        return EmbeddingCache(ingest_embedding_cache, f"{text_embeddings_model_type}:{text_embeddings_model}", ingest_embedding_cache_size)
+
+    def load_one_doc(self, filepath: Path, pages: range | None = None) -> list[Document]:
+        """load one document, or only some pages of a PDF or some members of a zip archive"""
         if self.verbose:
             print_HTML("<r>Processing {fname}</r>", fname=filepath.name)
+        if is_archive(filepath):
+            return load_archive(filepath, self.file_loaders, pages)
+        if pages is not None:
+            return PDFPageLoader(str(filepath), pages).load()
         if filepath.suffix[1:] not in self.file_loaders:
             if self.verbose:
                 print_HTML("<w>Unhandled file format: {fname} in {fparent}</w>", fname=filepath.name, fparent=filepath.parent)
@@ -73,98 +211,500 @@ class Ingester:
 
         return self.file_loaders[filepath.suffix[1:]](str(filepath)).load()
 
+    def task_units(self, filepath: Path) -> tuple[int, int]:
+        """number of pages of a PDF or of members of a zip archive, and how many of them make one task. 0 for files loaded at once."""
+        if filepath.suffix == ".pdf":
+            return PDFPageLoader.page_count(filepath), self.pdf_pages_per_task
+        if is_archive(filepath):
+            return len(list_members(filepath)), self.archive_members_per_task
+        return 0, 0
+
+    def plan_tasks(self, all_items: list[Path]) -> list[LoadTask]:
+        """split long PDFs into page ranges and zip archives into member ranges,
+        and order the tasks largest first so that big files don't end up in the tail of the run"""
+        tasks = []
+        for filepath in all_items:
+            try:
+                size = filepath.stat().st_size
+                n_units, per_task = self.task_units(filepath)
+            except OSError:  # deleted since it was listed, its loader reports it
+                size, n_units, per_task = 0, 0, 0
+            if n_units <= per_task:
+                tasks.append((filepath, None, 0, 1, size))
+                continue
+            ranges = [range(i, min(i + per_task, n_units)) for i in range(0, n_units, per_task)]
+            tasks += [(filepath, units, i, len(ranges), size * len(units) // n_units) for i, units in enumerate(ranges)]
+        return sorted(tasks, key=lambda task: task[4], reverse=True)
+
     def embed_documents_with_progress(self, embedding_function: Callable, documents: list[Document]) -> list[tuple[Any, Document]]:
         """wraps around embed_documents and saves"""
         if self.verbose:
             print_HTML(f"<r>Processing {len(documents)} chunks</r>")
 
-        embeddings = embedding_function([doc.page_content for doc in documents]).tolist()
-        return list(zip(embeddings, documents))
+        texts = [doc.page_content for doc in documents]
+        if self.embedding_cache is None:
+            return list(zip(np.asarray(embedding_function(texts)).tolist(), documents))
+
+        hashes = [self.chunk_id(text) for text in texts]
+        known = self.embedding_cache.get(hashes)
+        misses = {h: text for h, text in zip(hashes, texts) if h not in known}
+        if misses:
+            computed = np.asarray(embedding_function(list(misses.values())))
+            self.embedding_cache.put(list(misses), computed)
+            known |= dict(zip(misses, computed))
+        return [(known[h].tolist(), doc) for h, doc in zip(hashes, documents)]
+
+    @staticmethod
+    def chunk_id(text: str) -> str:
+        """ID of a chunk in the vector store"""
+        return md5(text.encode("utf-8")).hexdigest()
+
+    @property
+    def index(self) -> VectorIndex:
+        """the collection in the vector store, opened once. The local Qdrant store can only be used from the thread which opened it."""
+        if self._index is None:
+            os.makedirs(self.db_dir, exist_ok=True)  # holds the manifest's state, even with a Qdrant server
+            self._index = open_index(self.db_dir, self.collection)
+        return self._index
+
+    @property
+    def docstore(self) -> DocStore | None:
+        """the store of chunk texts when they are kept out of the vector store, opened once"""
+        if chunk_docstore and self._docstore is None:
+            self._docstore = DocStore(DocStore.path_for(self.db_dir, self.collection))
+        return self._docstore
+
+    def close_index(self) -> None:
+        """release the vector store, so that it can be reopened from another thread"""
+        if self._index is not None:
+            self._index.close()
+        self._index = None
+        if self._docstore is not None:
+            self._docstore.close()
+        self._docstore = None
+
+    def has_collection(self) -> bool:
+        """whether the collection exists. Only asks the store until it does."""
+        if not self.collection_exists:
+            self.collection_exists = self.index.exists()
+        return self.collection_exists
+
+    def create_collection(self, vector_size: int) -> None:
+        """create the collection"""
+        print_HTML(f"<r>Creating a new collection, vector size={vector_size}</r>")
+        self.index.create(vector_size)
+        self.collection_exists = True
+
+    def delete_chunks(self, ids: list[str]) -> None:
+        """remove chunks from the vector store"""
+        if not ids or not self.has_collection():
+            return
+        print_HTML(f"<r>Removing {len(ids)} outdated chunks</r>")
+        self.index.delete(ids)
+        if self.docstore is not None:
+            self.docstore.delete(ids)
+        if self.near_duplicates is not None:
+            self.near_duplicates.forget(ids)
+
+    def store_duplicate_sources(self) -> None:
+        """add the sources of the near-duplicates found to the metadata of the chunks representing them"""
+        if self.near_duplicates is None:
+            return
+        if updates := self.near_duplicates.pop_updates():
+            print_HTML(f"<r>{self.near_duplicates.n_dropped} near-duplicate chunks skipped so far, updating the sources of {len(updates)} chunks</r>")
+            if self.docstore is not None:
+                self.docstore.update_metadata(updates)
+            else:
+                self.index.set_metadata(updates)
+
+    def record_stored_files(self, stored_files: list[tuple[str, Path, list[str]]]) -> None:
+        """mark files whose chunks have all been stored in the manifest"""
+        if self.manifest is None:
+            return
+        for key, filepath, ids in stored_files:
+            self.manifest.record(key, filepath, ids)
+        self.manifest.checkpoint()
+
+    def load_projection(self) -> None:
+        """load the dimensionality reduction of the collection, which is kept once the collection is created"""
+        self.projection = Projection.load(Projection.path_for(self.db_dir, self.collection))
+        if self.projection is None:
+            if ingest_reduce_method != "none" and self.has_collection():
+                raise ValueError("The collection was created without dimensionality reduction, delete the db to enable INGEST_REDUCE_METHOD")
+        elif (self.projection.kind, self.projection.dim) != (ingest_reduce_method, ingest_reduce_dim):
+            print_HTML(f"<w>The collection keeps its {self.projection.kind} reduction to {self.projection.dim} dimensions, delete the db to change it</w>")
+
+    @staticmethod
+    def projection_sample_size() -> int:
+        """chunks to collect before fitting the configured reduction: a PCA needs at least as many as the reduced dimension"""
+        return max(ingest_reduce_sample, ingest_reduce_dim) if ingest_reduce_method == "pca" else 1
+
+    def fit_projection(self, sample: np.ndarray) -> None:
+        """fit the configured dimensionality reduction on a sample of embeddings, and save it with the collection"""
+        if len(sample) < self.projection_sample_size():
+            raise ValueError(
+                f"A {ingest_reduce_method} reduction to {ingest_reduce_dim} dimensions is fitted on the first {self.projection_sample_size()} chunks "
+                f"of the collection, but there are only {len(sample)}: ingest more documents at once, or set INGEST_REDUCE_METHOD=none"
+            )
+        print_HTML(f"<r>Fitting a {ingest_reduce_method} reduction from {sample.shape[1]} to {ingest_reduce_dim} dimensions on {len(sample)} chunks</r>")
+        self.projection = Projection.fit(ingest_reduce_method, ingest_reduce_dim, sample)
+        self.projection.save(Projection.path_for(self.db_dir, self.collection))
 
     def store_embeddings(self, embeddings_and_docs: list[tuple[Any, Document]], force: bool = False) -> None:
-        """store embeddings in vector store"""
+        """store embeddings in vector store
+        The storage itself is done by the background writer if it's running, while the next batch is being filled."""
         self.awaiting_storage += embeddings_and_docs
-        if not force and len(self.awaiting_storage) < self.store_N_batch:
+        fitting = self.projection is None and ingest_reduce_method != "none"  # wait for a sample to fit the projection on
+        if not force and len(self.awaiting_storage) < (max(self.store_N_batch, self.projection_sample_size()) if fitting else self.store_N_batch):
             return
-        client = QdrantClient(path=self.db_dir, prefer_grpc=True)
+        if fitting and self.awaiting_storage:
+            self.fit_projection(np.array([e[0] for e in self.awaiting_storage]))
+        batch = (self.awaiting_storage, self.awaiting_record)
+        self.awaiting_storage, self.awaiting_record = [], []
+        if self.store_queue is None:
+            self.write_batch(*batch)
+            return
+        self.store_queue.put(batch)  # blocks while the writer is busy with the previous batch
+        if self.writer_error is not None:
+            raise self.writer_error
+
+    def write_batch(self, embeddings_and_docs: list[tuple[Any, Document]], stored_files: list[tuple[str, Path, list[str]]]) -> None:
+        """upsert a batch of embeddings, then record the files it completes"""
+        start = time.perf_counter()
+        if embeddings_and_docs:
+            embeddings, documents = [e[0] for e in embeddings_and_docs], [e[1] for e in embeddings_and_docs]
+            if self.projection is not None:
+                embeddings = self.projection(np.array(embeddings)).tolist()
+            if not self.has_collection():
+                self.create_collection(max(len(e) for e in embeddings))
+
+            print_HTML(f"<r>Saving {len(embeddings_and_docs)} chunks</r>")
+            ids = [self.chunk_id(document.page_content) for document in documents]
+            if self.docstore is not None:  # stored first, so that every point can be resolved
+                self.docstore.put(ids, documents)
+                payloads = None
+            else:
+                payloads = [{"page_content": document.page_content, "metadata": document.metadata} for document in documents]
+            self.index.upsert(ids, embeddings, payloads)
+            if self.verbose:
+                print_HTML(f"<r>Saved, the collection now holds {self.index.count()} documents.</r>")
+        self.record_stored_files(stored_files)
+        if self.stats is not None:
+            self.stats.add("store", time.perf_counter() - start, files=len(stored_files), chunks=len(embeddings_and_docs))
+
+    def write_loop(self) -> None:
+        """body of the background writer: store batches until receiving None. The writer owns the index while it runs."""
+        while (batch := self.store_queue.get()) is not None:
+            if self.writer_error is not None:  # keep consuming so that the producer never blocks
+                continue
+            try:
+                self.write_batch(*batch)
+            except Exception as e:  # re-raised in the main thread
+                self.writer_error = e
+        self.close_index()
+
+    @contextlib.contextmanager
+    def background_writer(self) -> Iterator[None]:
+        """store batches in a background thread, so that storing one batch overlaps with embedding the next"""
+        self.store_queue, self.writer_error = queue.Queue(maxsize=1), None
+        self.close_index()
+        writer = threading.Thread(target=self.write_loop, daemon=True)
+        writer.start()
         try:
-            client.get_collection(self.collection)
-        except ValueError:  # doesn't exist
-            # Just do a single quick embedding to get vector size
-            vector_size = max(len(e[0]) for e in self.awaiting_storage)
-            print_HTML(f"<r>Creating a new collection, vector size={vector_size}</r>")
-            client.recreate_collection(
-                collection_name=self.collection,
-                vectors_config=models.VectorParams(
-                    size=vector_size,
-                    distance=models.Distance["COSINE"],
-                ),
-            )
+            yield
+        finally:
+            self.store_queue.put(None)
+            writer.join()
+            self.store_queue = None
+        if self.writer_error is not None:
+            raise self.writer_error
 
-        print_HTML(f"<r>Saving {len(self.awaiting_storage)} chunks</r>")
-        embeddings, texts, metadatas = (
-            [e[0] for e in self.awaiting_storage],
-            [e[1].page_content for e in self.awaiting_storage],
-            [e[1].metadata for e in self.awaiting_storage],
-        )
-        client.upsert(
-            collection_name=self.collection,
-            points=models.Batch.construct(
-                ids=[md5(text.encode("utf-8")).hexdigest() for text in texts],
-                vectors=embeddings,
-                payloads=[{"page_content": text, "metadata": metadatas[i]} for i, text in enumerate(texts)],
-            ),
+    def split_one_doc(self, task: LoadTask) -> tuple[LoadTask, list[Document], dict]:
+        """load and split one doc, or one part of it
+        :returns: the task, the chunks, and the timings of each step, with the error if it failed"""
+        filepath, pages, _, _, n_bytes = task
+        start = time.perf_counter()
+        try:
+            document = self.load_one_doc(filepath, pages)
+            loaded = time.perf_counter()
+            chunks = self.text_splitter.split_documents(document) if document else []
+            if self.llm_token_length is not None:
+                for chunk in chunks:
+                    chunk.metadata["n_tokens"], chunk.metadata["tokenizer"] = self.llm_token_length(chunk.page_content), llm_tokenizer
+        except Exception as e:  # e.g. an unreadable file, or one deleted since it was listed: the others are still ingested
+            return task, [], {"load": time.perf_counter() - start, "split": 0, "bytes": 0, "error": f"{type(e).__name__}: {e}"}
+        return task, chunks, {"load": loaded - start, "split": time.perf_counter() - loaded, "bytes": n_bytes}
+
+    def embed_batch(self, batch: Batch) -> tuple[EmbeddedBatch, dict]:
+        """embed a batch of chunks from several docs
+        :returns: (the files registered in the batch, and (file key, embedding, chunk) for each chunk), and the timing"""
+        start = time.perf_counter()
+        files, chunks = batch
+        keys, documents = [c[0] for c in chunks], [c[1] for c in chunks]
+        res = self.embed_documents_with_progress(self.encode_fun, documents) if documents else []
+        embedded = [(key, embedding, document) for key, (embedding, document) in zip(keys, res)]
+        return (files, embedded), {"embed": time.perf_counter() - start}
+
+    def open_manifest(self, chunk_size: int, chunk_overlap: int) -> None:
+        """load the manifest of the files already stored with the current settings"""
+        self.manifest = IngestManifest(
+            self.db_dir,
+            self.collection,
+            {
+                "model": text_embeddings_model,
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "splitter": ingest_splitter,
+                "tokenizer": ingest_chunk_tokenizer,
+                "docstore": chunk_docstore,
+                "backend": vector_backend,
+                "dedup_threshold": ingest_dedup_threshold,
+            },
         )
-        collection = client.get_collection(self.collection)
-        self.awaiting_storage = []
-        if self.verbose:
-            print_HTML(f"<r>Saved, the collection now holds {collection.points_count} documents.</r>")
 
-    def process_one_doc(self, filepath: Path) -> list[tuple[Any, Document]] | None:
-        """process one doc"""
-        document = self.load_one_doc(filepath)
-        if not document:
-            return None
-        split_document = self.text_splitter.split_documents(document)
-        res = self.embed_documents_with_progress(self.encode_fun, split_document)
-        if self.verbose:
-            print_HTML("<r>Processed {fname}</r>", fname=filepath.name)
-        return res
+    def scan_directory(self, path: str) -> list[Path]:
+        """list the files to (re-)ingest, and remove from the store the chunks of files which were deleted or modified"""
+        all_items = [Path(root) / file for root, dirs, files in os.walk(path) for file in files]
+        on_disk = {str(filepath.resolve()): filepath for filepath in all_items}
+        deleted = [key for key in self.manifest.keys_under(Path(path)) if key not in on_disk]
+        return self.forget_outdated(list(on_disk.values()), deleted)
 
-    def ingest_from_directory(self, path: str, chunk_size: int, chunk_overlap: int) -> None:
-        """ingest all supported files from the directory"""
-        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        self.encode_fun = get_embedding_model()[1]
+    def forget_outdated(self, candidates: list[Path], deleted: list[str]) -> list[Path]:
+        """remove the chunks of deleted files and of modified candidates from the store, return the new or modified candidates"""
+        to_process, vanished = [], []
+        for filepath in candidates:
+            try:
+                if not self.manifest.is_unchanged(str(filepath.resolve()), filepath):
+                    to_process.append(filepath)
+            except FileNotFoundError:  # deleted since it was listed
+                vanished.append(str(filepath.resolve()))
+        deleted = deleted + vanished
+        outdated = deleted + [str(filepath.resolve()) for filepath in to_process]
+        self.delete_chunks(self.manifest.unreferenced_ids(outdated))  # first, so that the entries are kept if the store is busy
+        self.manifest.forget(outdated)
+        self.manifest.save()
+        n_unchanged = len(candidates) - len(to_process) - len(vanished)
+        print_HTML(f"<r>{len(to_process)} new or modified files, {n_unchanged} unchanged, {len(deleted)} deleted</r>")
+        return to_process
 
-        # get all documents
+    def ingest_from_directory(self, path: str, chunk_size: int, chunk_overlap: int) -> None:
+        """ingest all new or modified supported files from the directory"""
+        self.open_manifest(chunk_size, chunk_overlap)
+        self.load_projection()
         print_HTML("<r>Scanning files</r>")
-        all_items = [Path(root) / file for root, dirs, files in os.walk(path) for file in files]
-        with ProgressBar() as pb:
-            with multiprocessing.Pool(self.n_threads) as pool:
-                for embeddings in pb(pool.imap_unordered(self.process_one_doc, all_items), total=len(all_items)):
-                    if embeddings is None:
-                        continue
-                    self.store_embeddings(embeddings)
-            self.store_embeddings(embeddings, force=True)
+        to_process = self.scan_directory(path)
+        with self.worker_pools(chunk_size, chunk_overlap) if to_process else contextlib.nullcontext():
+            self.ingest_files(to_process, chunk_size, chunk_overlap)
+
+    def ingest_files(self, all_items: list[Path], chunk_size: int, chunk_overlap: int) -> None:
+        """load, split, embed and store files, and record them in the manifest"""
+        if not all_items:
+            print_HTML("<r>Done</r>")
+            return
+        cache = self.open_embedding_cache()
+        cache_stats = cache.stats() if cache else {}
+        self.stats = IngestStats(ingest_stats_file, ingest_stats_interval)
+        with self.stats, ProgressBar() as pb, self.background_writer():
+            pb_files = pb(total=len(all_items))
+            try:
+                for completed_file in self.run_pipeline(all_items):
+                    pb_files.item_completed()
+                    if self.verbose:
+                        print_HTML("<r>Processed {fname}</r>", fname=completed_file.name)
+            finally:  # also checkpoint what's already embedded if interrupted
+                if self.writer_error is None:
+                    self.store_embeddings([], force=True)
+        self.manifest.save()
+        self.store_duplicate_sources()
+        if self.stats.path:
+            print_HTML("<r>Ingestion statistics written to {path}</r>", path=self.stats.path)
+        if cache:
+            hits, misses = (cache.stats()[k] - cache_stats[k] for k in ("hits", "misses"))
+            print_HTML(f"<r>Embedding cache: {hits} hits, {misses} misses</r>")
         print_HTML("<r>Done</r>")
 
+    def watch(self, path: str, chunk_size: int, chunk_overlap: int, interval: float, debounce: float) -> None:
+        """ingest the directory, then keep ingesting the files created, modified or deleted in it, until interrupted.
+        The worker processes, and so the embedding model, stay loaded in between.
+        The vector store is only held while storing: changes are kept pending while another process holds the local store (startLLM only holds it
+        during each query), and the ivf backend is written while startLLM reads it. Files which fail to load are skipped until they change again.
+        """
+        self.open_manifest(chunk_size, chunk_overlap)
+        self.load_projection()
+        watcher = DirectoryWatcher(path, debounce)
+        pending = {key: Path(key) for key in watcher.snapshot}
+        deleted = {key for key in self.manifest.keys_under(Path(path)) if key not in watcher.snapshot}
+        with self.worker_pools(chunk_size, chunk_overlap):
+            print_HTML(f"<r>Watching {path}, press Ctrl+C to stop</r>")
+            while True:
+                if pending or deleted:
+                    try:
+                        self.ingest_files(self.forget_outdated(list(pending.values()), list(deleted)), chunk_size, chunk_overlap)
+                        pending, deleted = {}, set()
+                    except StoreBusyError:
+                        print_HTML(f"<r>The vector store is in use by another process, retrying in {interval}s</r>")
+                    except Exception as e:  # files failing to load are skipped, this is anything else: keep watching
+                        print_HTML("<w>Ingestion failed, retrying in {interval}s: {error}</w>", interval=str(interval), error=f"{type(e).__name__}: {e}")
+                    finally:
+                        self.close_index()
+                time.sleep(interval)
+                changed, removed = watcher.poll()
+                pending |= {str(filepath): filepath for filepath in changed}
+                for key in removed:
+                    pending.pop(key, None)
+                    deleted.add(key)
+
+    @contextlib.contextmanager
+    def worker_pools(self, chunk_size: int, chunk_overlap: int) -> Iterator[None]:
+        """start the loader and embedding processes, which run_pipeline uses until exiting"""
+        profile_dir = str(IngestStats(ingest_stats_file).profile_dir) if self.profile else None
+        with (
+            multiprocessing.Pool(self.n_loaders, _init_loader_worker, (self.verbose, chunk_size, chunk_overlap, profile_dir)) as loader_pool,
+            multiprocessing.Pool(self.n_embedders, _init_embedding_worker, (self.verbose, profile_dir)) as embedding_pool,
+        ):
+            self.pools = loader_pool, embedding_pool
+            try:
+                yield
+            finally:
+                self.pools = None
+            for pool in (loader_pool, embedding_pool):  # let the workers exit cleanly, so that their profiles get written
+                pool.close()
+                pool.join()
+
+    def run_pipeline(self, all_items: list[Path]) -> Iterator[Path]:
+        """load -> split -> batch -> embed -> store, all stages running concurrently, in the worker pools.
+        Each hand-off is bounded (max_queued_files, max_queued_batches, store_N_batch) so that memory doesn't depend on the corpus size.
+        Yields each file once all its chunks have been embedded."""
+        stop = threading.Event()
+        loaded = self.stats.watch_queue("loaded_files", Backpressure(self.max_queued_files, stop))
+        embedded = self.stats.watch_queue("embedding_batches", Backpressure(self.max_queued_batches, stop))
+        loader_pool, embedding_pool = self.pools
+        self.failed_files = set()
+        try:
+            tasks = self.plan_tasks(all_items)
+            split_documents = loaded.drain(loader_pool.imap_unordered(_split_one_doc, loaded.feed(tasks)), self.check_loaded)
+            batcher = ChunkBatcher(self.embed_batch_size, self.embed_batch_timeout, near_duplicates=self.near_duplicates)
+            batches = batcher.batches(split_documents, len(tasks))
+            embedded_batches = embedded.drain(embedding_pool.imap_unordered(_embed_batch, embedded.feed(batches)), self.stats.embedded)
+            yield from self.collect_embedded_files(embedded_batches, all_items)
+        finally:
+            stop.set()
+
+    def check_loaded(self, result: tuple) -> tuple:
+        """account for a load task, and report its file if it failed to load"""
+        (filepath, *_), _, timings = result
+        if "error" in timings:
+            self.failed_files.add(str(filepath.resolve()))
+            print_HTML("<w>Skipping {fname}, which failed to load: {error}</w>", fname=str(filepath), error=timings["error"])
+        return self.stats.loaded(result)
+
+    def collect_embedded_files(self, embedded_batches: Iterator[EmbeddedBatch], all_items: list[Path]) -> Iterator[Path]:
+        """store embedded batches, and yield each file once all its chunks have been embedded"""
+        filepaths = {str(filepath.resolve()): filepath for filepath in all_items}
+        remaining, ids, registered = defaultdict(int), defaultdict(list), set()
+        for files, embedded in embedded_batches:
+            for key, embedding, document in embedded:
+                remaining[key] -= 1
+                ids[key].append(self.chunk_id(document.page_content))
+            self.awaiting_storage += [(embedding, document) for _, embedding, document in embedded]
+            for key, n_chunks in files:
+                remaining[key] += n_chunks
+                registered.add(key)
+            for key in [k for k in registered if remaining[k] == 0]:
+                registered.remove(key)
+                del remaining[key]
+                duplicates = self.near_duplicates.duplicates.pop(key, []) if self.near_duplicates is not None else []
+                file_ids = ids.pop(key, []) + duplicates
+                if key not in self.failed_files:  # else loaded again by the next run, or once modified with --watch
+                    self.awaiting_record.append((key, filepaths[key], file_ids))
+                yield filepaths[key]
+            self.store_embeddings([])
+
+
+def get_text_splitter(chunk_size: int, chunk_overlap: int) -> TextSplitter:
+    """the configured text splitter"""
+    match ingest_splitter:
+        case "recursive":
+            return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        case "fast":
+            token_length = get_token_length(ingest_chunk_tokenizer) if ingest_chunk_tokenizer else None
+            return FastTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, token_length=token_length)
+        case _:
+            raise ValueError(f"Unknown splitter {ingest_splitter}")
+
+
+_worker: dict[str, Ingester] = {}  # per-process state of the pool workers, set once by their initializer
+
+
+def _profile_worker(profile_dir: str | None, role: str) -> None:
+    """profile the current worker process until it exits"""
+    if profile_dir is None:
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    multiprocessing.util.Finalize(None, profiler.dump_stats, (os.path.join(profile_dir, f"{role}.{os.getpid()}.prof"),), exitpriority=10)
+
+
+def _init_loader_worker(verbose: bool, chunk_size: int, chunk_overlap: int, profile_dir: str | None) -> None:
+    """initialize a process which loads and splits files"""
+    _profile_worker(profile_dir, "loader")
+    ingester = Ingester("", verbose=verbose)
+    ingester.text_splitter = get_text_splitter(chunk_size, chunk_overlap)
+    _worker["ingester"] = ingester
+
+
+def _init_embedding_worker(verbose: bool, profile_dir: str | None) -> None:
+    """initialize a process which embeds chunks. The embedding model is loaded once per process."""
+    _profile_worker(profile_dir, "embedder")
+    ingester = Ingester("", verbose=verbose)
+    ingester.encode_fun = get_embedding_model()[1]
+    ingester.embedding_cache = Ingester.open_embedding_cache()
+    _worker["ingester"] = ingester
+
+
+def _split_one_doc(task: LoadTask) -> tuple[LoadTask, list[Document], dict]:
+    """task of the loader pool"""
+    return _worker["ingester"].split_one_doc(task)
+
+
+def _embed_batch(batch: Batch) -> tuple[EmbeddedBatch, dict]:
+    """task of the embedding pool"""
+    return _worker["ingester"].embed_batch(batch)
+
 
-def main(sources_directory: str, cleandb: str) -> None:
-    """main function"""
+def main(sources_directory: str, cleandb: str, resume: bool = False, profile: bool = False, watch: bool = False) -> None:
+    """main function
+    :param resume: continue an interrupted ingestion: keep the db and skip the files already stored
+    :param profile: write cProfile stats of the worker processes
+    :param watch: keep ingesting the changes in the directory until interrupted"""
     ingester = Ingester(persist_directory)
+    ingester.profile = profile
     session = PromptSession()
 
     if os.path.exists(ingester.db_dir):
-        if cleandb.lower() == "y" or (cleandb == "n" and prompt_HTML(session, "\n<b><w>Delete current database?(Y/N)</w></b>: ").lower() == "y"):
+        if resume or watch:
+            print_HTML("<r>Resuming ingestion...</r>")
+        elif cleandb.lower() == "y" or (cleandb == "n" and prompt_HTML(session, "\n<b><w>Delete current database?(Y/N)</w></b>: ").lower() == "y"):
             print_HTML("<r>Deleting db...</r>")
+            if qdrant_url and vector_backend == "qdrant":
+                ingester.index.drop()
+                ingester.close_index()
             shutil.rmtree(ingester.db_dir)
+            for manifest in Path(ingester.db_dir).parent.glob(f"{Path(ingester.db_dir).name}.*.manifest.*"):
+                manifest.unlink()
         elif cleandb.lower() == "n":
             print_HTML("<r>Adding to db...</r>")
 
-    ingester.ingest_from_directory(sources_directory, chunk_size, chunk_overlap)
+    if watch:
+        ingester.watch(sources_directory, chunk_size, chunk_overlap, ingest_watch_interval, ingest_watch_debounce)
+    else:
+        ingester.ingest_from_directory(sources_directory, chunk_size, chunk_overlap)
 
 
 if __name__ == "__main__":
-    sources_directory = sys.argv[1] if len(sys.argv) > 1 else documents_directory
-    cleandb = sys.argv[2] if len(sys.argv) > 2 else "n"
-    main(sources_directory, cleandb)
+    resume, profile, watch = "--resume" in sys.argv, "--profile" in sys.argv, "--watch" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg not in ("--resume", "--profile", "--watch")]
+    sources_directory = args[0] if len(args) > 0 else documents_directory
+    cleandb = args[1] if len(args) > 1 else "n"
+    main(sources_directory, cleandb, resume, profile, watch)
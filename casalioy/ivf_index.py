@@ -0,0 +1,301 @@
+"""a native approximate nearest neighbor index, fully offline: an inverted file (IVF) over memory-mapped vectors"""
+import contextlib
+import json
+import math
+import os
+import shutil
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+import numpy as np
+import portalocker
+
+from casalioy.load_env import ivf_nprobe, ivf_probe_fraction
+from casalioy.utils import collection_path
+from casalioy.vector_store import StoreBusyError, VectorIndex
+
+
+class Hit(NamedTuple):
+    """a search result, with the attributes of qdrant's ScoredPoint"""
+
+    id: str
+    score: float
+    payload: dict | None
+    vector: list[float] | None
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """vectors scaled to unit length, so that dot products are cosine similarities"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def append(array: np.ndarray, size: int, values: np.ndarray) -> np.ndarray:
+    """array with values written after its first size items, grown by doubling when full"""
+    if size + len(values) > len(array):
+        grown = np.zeros(max(2 * len(array), size + len(values)), dtype=array.dtype)
+        grown[:size] = array[:size]
+        array = grown
+    array[size : size + len(values)] = values
+    return array
+
+
+class IVFIndex(VectorIndex):
+    """vectors clustered by k-means into about sqrt(n) lists: a search only scores the vectors of the nprobe lists whose
+    centroids are the most similar to the query, i.e. about nprobe * sqrt(n) vectors instead of n. By default nprobe is a
+    fixed share of the lists (probe_fraction), so that the recall doesn't drop as the index grows, for a constant speedup.
+    Between trainings the files are append-only: vectors.f32 (normalized float32 rows, memory-mapped), ids.bin (hex IDs),
+    lists.i32 (list of each row) and deleted.i64 (deleted rows), so that a batch is stored in O(batch).
+    When the rows added since the last training outnumber the others, the lists are trained again and the files rewritten
+    sorted by list and without the deleted rows: each list is then a contiguous slice of the memory map.
+    There are no payloads, chunks are kept in the docstore.
+    One writer at a time locks the index, and readers (read_only) don't block it: they load the committed rows, and load
+    again before a search once meta.json has changed. Loading only waits while the writer replaces the files after a training.
+    """
+
+    has_payloads = False
+
+    min_train = 4096  # below this many rows, searches are exact
+    sample_per_list = 64  # vectors sampled per list to train the k-means
+    kmeans_iterations = 10
+    block = 65536  # rows scored at once when assigning and rewriting
+
+    def __init__(self, path: str | Path, nprobe: int = ivf_nprobe, read_only: bool = False, probe_fraction: float = ivf_probe_fraction):
+        self.path = Path(path)
+        self.nprobe = nprobe  # 0 for probe_fraction of the lists
+        self.probe_fraction = probe_fraction
+        self.read_only = read_only
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = None
+        if not read_only:
+            self.lock = open(self.path.with_name(f"{self.path.name}.lock"), "a")
+            try:
+                portalocker.lock(self.lock, portalocker.LOCK_EX | portalocker.LOCK_NB)
+            except portalocker.LockException as e:
+                self.lock.close()
+                raise StoreBusyError(f"The index at {self.path} is already written by another process") from e
+            staged = self.path.with_name(f"{self.path.name}.new")
+            if staged.exists() and not self.path.exists():  # interrupted while replacing the files by rewrite
+                staged.rename(self.path)
+        self.load()
+
+    @staticmethod
+    def path_for(db_dir: str, collection: str) -> Path:
+        """where the index of a collection is kept"""
+        return collection_path(db_dir, f"ivf.{collection}")
+
+    @contextlib.contextmanager
+    def files_lock(self, flags: int) -> Iterator[None]:
+        """held by readers while loading the files (shared), and by the writer while replacing them (exclusive)"""
+        with open(self.path.with_name(f"{self.path.name}.files.lock"), "a") as f:
+            portalocker.lock(f, flags)
+            yield
+
+    def meta_version(self) -> tuple[int, int] | None:
+        """changes whenever the metadata is written, None while there is none"""
+        try:
+            stat = (self.path / "meta.json").stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def load(self) -> None:
+        """read the state of the index, dropping rows written after its metadata by an interrupted upsert"""
+        with self.files_lock(portalocker.LOCK_SH) if self.read_only else contextlib.nullcontext():
+            self.version = self.meta_version()
+            meta = json.loads((self.path / "meta.json").read_text()) if self.version else {"dim": 0, "size": 0, "n_sorted": 0}
+            self.dim, self.size, self.n_sorted = meta["dim"], meta["size"], meta["n_sorted"]
+            if self.version and not self.read_only:
+                for name, itemsize in (("vectors.f32", 4 * self.dim), ("ids.bin", 32), ("lists.i32", 4)):
+                    os.truncate(self.path / name, self.size * itemsize)
+            self.ids = np.fromfile(self.path / "ids.bin", dtype="S32", count=self.size) if self.size else np.zeros(0, dtype="S32")
+            self.lists = np.fromfile(self.path / "lists.i32", dtype=np.int32, count=self.size) if self.size else np.zeros(0, dtype=np.int32)
+            self.deleted = np.zeros(self.size, dtype=bool)
+            if self.size:
+                deleted = np.fromfile(self.path / "deleted.i64", dtype=np.int64)
+                self.deleted[deleted[deleted < self.size]] = True  # a reader ignores the rows appended after it read the metadata
+            self.n_deleted = int(self.deleted.sum())
+            self.centroids = np.load(self.path / "centroids.npy") if (self.path / "centroids.npy").exists() else None
+            self.offsets = np.load(self.path / "offsets.npy") if (self.path / "offsets.npy").exists() else None
+            self._vectors, self._rows, self._tail = None, None, None
+            if self.read_only and self.size:  # mapped now, the file can be replaced by the writer afterwards
+                _ = self.vectors
+
+    def refresh(self) -> None:
+        """load the index again if the writer has committed changes since it was loaded"""
+        if self.meta_version() != self.version:
+            self.load()
+
+    def save_meta(self, path: Path | None = None) -> None:
+        """write the metadata, which commits the rows appended before"""
+        path = path or self.path
+        (path / "meta.json.tmp").write_text(json.dumps({"dim": self.dim, "size": self.size, "n_sorted": self.n_sorted}))
+        os.replace(path / "meta.json.tmp", path / "meta.json")
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """the memory-mapped vectors, mapped again after appends"""
+        if self._vectors is None:
+            self._vectors = np.memmap(self.path / "vectors.f32", dtype=np.float32, mode="r", shape=(self.size, self.dim))
+        return self._vectors
+
+    @property
+    def rows(self) -> dict[str, int]:
+        """row of each live ID, built when first writing"""
+        if self._rows is None:
+            self._rows = {key.decode(): row for row, key in enumerate(self.ids[: self.size]) if not self.deleted[row]}
+        return self._rows
+
+    @property
+    def tail(self) -> tuple[np.ndarray, np.ndarray]:
+        """rows added since the last training sorted by list, and where each list starts among them"""
+        if self._tail is None:
+            lists = self.lists[self.n_sorted : self.size]
+            order = np.argsort(lists, kind="stable")
+            self._tail = self.n_sorted + order, np.searchsorted(lists[order], np.arange(len(self.centroids) + 1))
+        return self._tail
+
+    def exists(self) -> bool:
+        return (self.path / "meta.json").exists()
+
+    def create(self, vector_size: int) -> None:
+        self.drop()
+        self.path.mkdir(parents=True)
+        for name in ("vectors.f32", "ids.bin", "lists.i32", "deleted.i64"):
+            (self.path / name).touch()
+        self.dim = vector_size
+        self.save_meta()
+        self.load()
+
+    def upsert(self, ids: list[str], vectors: list[list[float]], payloads: list[dict] | None) -> None:
+        if payloads is not None:
+            raise ValueError("The ivf backend keeps chunks in the docstore")
+        last = dict(zip(ids, range(len(ids))))  # an ID repeated in the batch keeps its last vector
+        ids, vectors = list(last), normalize(vectors)[list(last.values())]
+        self.delete([key for key in ids if key in self.rows])
+        lists = self.assign(vectors) if self.centroids is not None else np.full(len(ids), -1, dtype=np.int32)
+        for name, values in (("vectors.f32", vectors), ("ids.bin", np.array(ids, dtype="S32")), ("lists.i32", lists)):
+            with open(self.path / name, "ab") as f:
+                f.write(values.tobytes())
+        self.ids, self.lists = append(self.ids, self.size, np.array(ids, dtype="S32")), append(self.lists, self.size, lists)
+        self.deleted = append(self.deleted, self.size, np.zeros(len(ids), dtype=bool))
+        self.rows.update(zip(ids, range(self.size, self.size + len(ids))))
+        self.size += len(ids)
+        self.save_meta()
+        self._vectors, self._tail = None, None
+        if self.size >= self.min_train and self.size - self.n_sorted > self.n_sorted:
+            self.train()
+
+    def delete(self, ids: list[str]) -> None:
+        rows = np.array([self.rows.pop(key) for key in ids if key in self.rows], dtype=np.int64)
+        if len(rows):
+            with open(self.path / "deleted.i64", "ab") as f:
+                f.write(rows.tobytes())
+            self.deleted[rows] = True
+            self.n_deleted += len(rows)
+
+    def set_metadata(self, metadatas: dict[str, dict]) -> None:
+        raise ValueError("The ivf backend keeps chunks in the docstore")
+
+    def count(self) -> int:
+        return self.size - self.n_deleted
+
+    def drop(self) -> None:
+        self._vectors = None
+        with self.files_lock(portalocker.LOCK_EX):
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.load()
+
+    def assign(self, vectors: np.ndarray) -> np.ndarray:
+        """list of each vector: the one of its most similar centroid"""
+        return np.concatenate([(vectors[i : i + self.block] @ self.centroids.T).argmax(axis=1) for i in range(0, len(vectors), self.block)]).astype(np.int32)
+
+    def kmeans(self, sample: np.ndarray, n_lists: int) -> np.ndarray:
+        """centroids of a spherical k-means of the sample"""
+        rng = np.random.default_rng(0)
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(self.kmeans_iterations):
+            assignment = (sample @ centroids.T).argmax(axis=1)
+            order, counts = np.argsort(assignment, kind="stable"), np.bincount(assignment, minlength=n_lists)
+            filled = counts > 0  # empty lists keep their centroid
+            centroids[filled] = np.add.reduceat(sample[order], (np.cumsum(counts) - counts)[filled])
+            centroids = normalize(centroids)
+        return centroids
+
+    def train(self) -> None:
+        """cluster the live vectors into lists, and rewrite the files sorted by list without the deleted rows"""
+        live = np.flatnonzero(~self.deleted[: self.size])
+        n_lists = max(1, math.isqrt(len(live)))
+        rng = np.random.default_rng(0)
+        sample = np.asarray(self.vectors[np.sort(rng.choice(live, min(len(live), self.sample_per_list * n_lists), replace=False))])
+        self.centroids = self.kmeans(sample, n_lists)
+        lists = np.concatenate([self.assign(np.asarray(self.vectors[live[i : i + self.block]])) for i in range(0, len(live), self.block)])
+        order = np.argsort(lists, kind="stable")
+        rows, lists = live[order], lists[order]
+
+        staged = self.path.with_name(f"{self.path.name}.new")
+        shutil.rmtree(staged, ignore_errors=True)
+        staged.mkdir()
+        with open(staged / "vectors.f32", "wb") as f:
+            for i in range(0, len(rows), self.block):
+                f.write(np.ascontiguousarray(self.vectors[rows[i : i + self.block]]).tobytes())
+        self.ids[rows].tofile(staged / "ids.bin")
+        lists.tofile(staged / "lists.i32")
+        (staged / "deleted.i64").touch()
+        np.save(staged / "centroids.npy", self.centroids)
+        np.save(staged / "offsets.npy", np.searchsorted(lists, np.arange(n_lists + 1)))
+        self.size = self.n_sorted = len(rows)
+        self.save_meta(staged)
+        self._vectors = None  # unmapped before its file is removed
+        with self.files_lock(portalocker.LOCK_EX):
+            shutil.rmtree(self.path)
+            staged.rename(self.path)
+        self.load()
+
+    @property
+    def n_probed(self) -> int:
+        """lists searched per query"""
+        if self.centroids is None:
+            return 0
+        return self.nprobe or max(1, math.ceil(self.probe_fraction * len(self.centroids)))
+
+    def candidates(self, query: np.ndarray) -> tuple[list[tuple[int, int]], np.ndarray]:
+        """contiguous ranges of rows, and other rows, to score for a query: those of the lists closest to it"""
+        if self.centroids is None:
+            return [(0, self.size)], np.zeros(0, dtype=np.int64)
+        similarities, n_probed = self.centroids @ query, self.n_probed
+        probed = np.argpartition(-similarities, n_probed - 1)[:n_probed] if n_probed < len(similarities) else range(len(similarities))
+        tail, starts = self.tail
+        ranges = [(self.offsets[i], self.offsets[i + 1]) for i in probed]
+        return ranges, np.concatenate([tail[starts[i] : starts[i + 1]] for i in probed])
+
+    def search(self, vector: list[float], limit: int, with_payload: bool = True, with_vectors: bool = False, filter: dict | None = None) -> list[Hit]:
+        if filter:
+            raise ValueError("The ivf backend doesn't support metadata filters")
+        if self.read_only:
+            self.refresh()
+        if self.count() == 0:
+            return []
+        query = normalize(vector)
+        ranges, others = self.candidates(query)
+        rows = np.concatenate([np.arange(start, stop) for start, stop in ranges] + [others])
+        scores = np.concatenate([self.vectors[start:stop] @ query for start, stop in ranges] + [self.vectors[others] @ query])
+        live = ~self.deleted[rows]
+        rows, scores = rows[live], scores[live]
+        if len(rows) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores)
+        return [
+            Hit(self.ids[row].decode(), float(score), None, self.vectors[row].tolist() if with_vectors else None)
+            for row, score in zip(rows[order], scores[order])
+        ]
+
+    def retrieve(self, ids: list[str]) -> list[Hit]:
+        raise ValueError(f"{len(ids)} chunks are missing from the docstore, which the ivf backend relies on: ingest the documents again")
+
+    def close(self) -> None:
+        self._vectors, self.version = None, ()  # a reader loads the index again if it is used after
+        if self.lock is not None:
+            self.lock.close()  # releases the lock
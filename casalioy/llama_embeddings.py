@@ -0,0 +1,62 @@
+"""LlamaCpp embeddings computed in batches, over a pool of model contexts"""
+import inspect
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+class LlamaCppPoolEmbeddings(Embeddings):
+    """embeddings of a llama.cpp model, spread over n_contexts contexts evaluated in parallel threads
+    All contexts mmap the same model file, so the weights are in memory once; each context only adds its own KV cache.
+    llama.cpp releases the GIL while evaluating, so the threads run concurrently.
+    Texts are processed by batches of batch_size: recent llama-cpp-python versions pack a batch into a single evaluation
+    (one sequence per text), older ones embed the texts of the batch one by one on the same context.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int, n_gpu_layers: int = 0, use_mlock: bool = False, n_contexts: int = 1, batch_size: int = 32):
+        from llama_cpp import Llama
+
+        self.batch_size = batch_size
+        self.n_contexts = n_contexts
+        self.packed = "truncate" in inspect.signature(Llama.embed).parameters  # embed() takes a list of texts since this parameter exists
+        n_threads = max((os.cpu_count() or 1) // n_contexts, 1)
+        self.contexts = queue.Queue()
+        for _ in range(n_contexts):
+            llama = Llama(
+                model_path=model_path,
+                n_ctx=n_ctx,
+                n_batch=n_ctx,
+                n_threads=n_threads,
+                n_gpu_layers=n_gpu_layers,
+                use_mlock=use_mlock,
+                use_mmap=True,
+                embedding=True,
+                verbose=False,
+            )
+            self.contexts.put(llama)
+        self.executor = ThreadPoolExecutor(n_contexts) if n_contexts > 1 else None
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """embed texts on the first available context"""
+        llama = self.contexts.get()
+        try:
+            return llama.embed(texts) if self.packed else [llama.embed(text) for text in texts]
+        finally:
+            self.contexts.put(llama)
+
+    def encode(self, texts: str | list[str]) -> np.ndarray:
+        """embed a text or a list of texts, same interface as SentenceTransformer.encode"""
+        if isinstance(texts, str):
+            return self.encode([texts])[0]
+        batches = [texts[i : i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        results = self.executor.map(self.embed_batch, batches) if self.executor else map(self.embed_batch, batches)
+        return np.array([embedding for batch in results for embedding in batch], dtype=np.float32)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.encode(text).tolist()
@@ -1,24 +1,68 @@
 """load env variables"""
 import os
-from typing import Callable
+from typing import Any, Callable
 
 from dotenv import load_dotenv
-from langchain.embeddings import HuggingFaceEmbeddings, LlamaCppEmbeddings
+from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.prompts import PromptTemplate
 
+from casalioy.hash_embeddings import HashEmbeddings
+from casalioy.llama_embeddings import LlamaCppPoolEmbeddings
+from casalioy.reranker import Reranker
 from casalioy.utils import download_if_repo
 
 load_dotenv()
 text_embeddings_model = os.environ.get("TEXT_EMBEDDINGS_MODEL")
 text_embeddings_model_type = os.environ.get("TEXT_EMBEDDINGS_MODEL_TYPE")
 use_mlock = os.environ.get("USE_MLOCK").lower() == "true"
+text_embeddings_n_contexts = int(os.environ.get("TEXT_EMBEDDINGS_N_CONTEXTS", 1))  # LlamaCpp contexts embedding in parallel threads
+text_embeddings_batch_size = int(os.environ.get("TEXT_EMBEDDINGS_BATCH_SIZE", 32))  # LlamaCpp texts embedded per call on a context
 
 # ingest
 persist_directory = os.environ.get("PERSIST_DIRECTORY")
 documents_directory = os.environ.get("DOCUMENTS_DIRECTORY")
 chunk_size = int(os.environ.get("INGEST_CHUNK_SIZE"))
 chunk_overlap = int(os.environ.get("INGEST_CHUNK_OVERLAP"))
+ingest_splitter = os.environ.get("INGEST_SPLITTER", "fast")  # fast (single pass) or recursive (langchain)
+ingest_chunk_tokenizer = os.environ.get("INGEST_CHUNK_TOKENIZER", "")  # with the fast splitter, count chunk sizes in tokens of the "embedding" or "llm" model
+ingest_count_llm_tokens = os.environ.get("INGEST_COUNT_LLM_TOKENS", "false").lower() == "true"  # store chunk sizes in LlamaCpp LLM tokens
 ingest_n_threads = int(os.environ.get("INGEST_N_THREADS", 1))
+ingest_n_loaders = int(os.environ.get("INGEST_N_LOADERS", ingest_n_threads))  # processes loading and splitting files
+ingest_n_embedders = int(os.environ.get("INGEST_N_EMBEDDERS", 1))  # processes holding a copy of the embedding model
+ingest_embed_batch_size = int(os.environ.get("INGEST_EMBED_BATCH_SIZE", 256))  # max chunks per embedding call, across files
+ingest_embed_batch_timeout = float(os.environ.get("INGEST_EMBED_BATCH_TIMEOUT", 2))  # seconds before a partial batch is embedded anyway
+ingest_pdf_pages_per_task = int(os.environ.get("INGEST_PDF_PAGES_PER_TASK", 50))  # longer PDFs are extracted by page ranges in parallel
+ingest_archive_members_per_task = int(os.environ.get("INGEST_ARCHIVE_MEMBERS_PER_TASK", 20))  # zip archives are loaded by groups of members in parallel
+ingest_dedup_threshold = float(os.environ.get("INGEST_DEDUP_THRESHOLD", 0))  # drop chunks this similar (Jaccard) to one already seen, 0 to disable
+ingest_reduce_method = os.environ.get("INGEST_REDUCE_METHOD", "none")  # none, pca or truncate, applied to the embeddings of new collections
+ingest_reduce_dim = int(os.environ.get("INGEST_REDUCE_DIM", 128))  # dimension of the reduced embeddings
+ingest_reduce_sample = int(os.environ.get("INGEST_REDUCE_SAMPLE", 5000))  # chunks the PCA is fitted on
+# next to the db directory by default, so that rebuilding the db (cleandb=y) reuses it
+ingest_embedding_cache = os.environ.get("INGEST_EMBEDDING_CACHE") or f"{os.path.normpath(persist_directory or 'db')}.embeddings_cache.sqlite"
+ingest_embedding_cache = "" if ingest_embedding_cache == "none" else ingest_embedding_cache
+ingest_embedding_cache_size = int(os.environ.get("INGEST_EMBEDDING_CACHE_SIZE", 1_000_000))  # max number of cached embeddings
+ingest_stats_file = os.environ.get("INGEST_STATS_FILE", "ingest_stats.json")  # JSON report of the stages' throughput, empty to disable
+ingest_stats_interval = float(os.environ.get("INGEST_STATS_INTERVAL", 0))  # seconds between snapshots of the report while ingesting, 0 to disable
+ingest_max_queued_files = int(os.environ.get("INGEST_MAX_QUEUED_FILES", 2 * ingest_n_loaders))  # loaded files waiting to be batched
+ingest_max_queued_batches = int(os.environ.get("INGEST_MAX_QUEUED_BATCHES", 2 * ingest_n_embedders))  # batches waiting for or done embedding
+ingest_watch_interval = float(os.environ.get("INGEST_WATCH_INTERVAL", 2))  # seconds between scans of the directory with --watch
+ingest_watch_debounce = float(os.environ.get("INGEST_WATCH_DEBOUNCE", 5))  # seconds a file must stay unchanged before it is ingested with --watch
+
+# vector store
+vector_backend = os.environ.get("VECTOR_BACKEND", "qdrant")  # qdrant (local store or server) or ivf (approximate index in PERSIST_DIRECTORY)
+ivf_nprobe = int(os.environ.get("IVF_NPROBE", 0))  # clusters of the ivf index searched per query, 0 for IVF_PROBE_FRACTION of them
+ivf_probe_fraction = float(os.environ.get("IVF_PROBE_FRACTION", 0.15))  # share of the clusters searched per query: higher is more accurate and slower
+qdrant_url = os.environ.get("QDRANT_URL", "")  # Qdrant server, empty for the local store in PERSIST_DIRECTORY
+qdrant_quantization = os.environ.get("QDRANT_QUANTIZATION", "none")  # none, scalar or product
+qdrant_quantization_always_ram = os.environ.get("QDRANT_QUANTIZATION_ALWAYS_RAM", "true").lower() == "true"
+qdrant_on_disk_vectors = os.environ.get("QDRANT_ON_DISK_VECTORS", "false").lower() == "true"
+qdrant_on_disk_payload = os.environ.get("QDRANT_ON_DISK_PAYLOAD", "false").lower() == "true"
+qdrant_on_disk_index = os.environ.get("QDRANT_ON_DISK_INDEX", "false").lower() == "true"
+qdrant_hnsw_m = int(os.environ.get("QDRANT_HNSW_M", 16))
+qdrant_hnsw_ef_construct = int(os.environ.get("QDRANT_HNSW_EF_CONSTRUCT", 100))
+qdrant_hnsw_ef = int(os.environ.get("QDRANT_HNSW_EF", 0)) or None  # candidates explored per search, 0 for the server default
+qdrant_rescore = os.environ.get("QDRANT_RESCORE", "true").lower() == "true"  # rescore quantized results with the original vectors
+chunk_docstore = os.environ.get("CHUNK_DOCSTORE", "false").lower() == "true" or vector_backend == "ivf"  # chunk texts in a docstore, not in the vectors
 
 # generate
 model_type = os.environ.get("MODEL_TYPE")
@@ -28,16 +72,28 @@ model_max_tokens = int(os.environ.get("MODEL_MAX_TOKENS"))
 model_temp = float(os.environ.get("MODEL_TEMP", "0.8"))
 model_stop = os.environ.get("MODEL_STOP", "")
 model_stop = model_stop.split(",") if model_stop else []
+model_prefix_cache = os.environ.get("MODEL_PREFIX_CACHE", "true").lower() == "true"  # keep the LlamaCpp state of the chains' instructions between questions
 chain_type = os.environ.get("CHAIN_TYPE", "refine")
+refine_min_score = float(os.environ.get("REFINE_MIN_SCORE") or "-inf")  # betterrefine skips extracts less similar to the question
+refine_patience = int(os.environ.get("REFINE_PATIENCE", 0))  # betterrefine stops once the answer is unchanged for this many extracts, 0 to use all
+mapreduce_n_workers = max(int(os.environ.get("MAPREDUCE_N_WORKERS", 2)), 1)  # LLM instances answering groups of extracts concurrently in bettermapreduce
+mapreduce_group_size = int(os.environ.get("MAPREDUCE_GROUP_SIZE", 0))  # extracts per group in bettermapreduce, 0 to share them equally between workers
 n_retrieve_documents = int(os.environ.get("N_RETRIEVE_DOCUMENTS", 25))
 n_forward_documents = int(os.environ.get("N_FORWARD_DOCUMENTS", 3))
+rerank_model = os.environ.get("RERANK_MODEL", "")  # cross-encoder reranking the retrieved candidates in the better* chains, empty to disable
+rerank_batch_size = int(os.environ.get("RERANK_BATCH_SIZE", 32))
+rerank_n_threads = int(os.environ.get("RERANK_N_THREADS", 0))  # torch threads of the reranker, 0 for torch's default
+rerank_min_score = float(os.environ.get("RERANK_MIN_SCORE") or "-inf")  # reranked candidates scoring below this aren't forwarded
+mmr_lambda = float(os.environ.get("MMR_LAMBDA", 0.5))  # relevance vs diversity of the forwarded documents: 1 for the most relevant, 0 for the most diverse
 n_gpu_layers = int(os.environ.get("N_GPU_LAYERS", 0))
 
-text_embeddings_model = download_if_repo(text_embeddings_model)
+text_embeddings_model = text_embeddings_model if text_embeddings_model_type == "Hash" else download_if_repo(text_embeddings_model)
 model_path = download_if_repo(model_path)
+rerank_model = rerank_model and download_if_repo(rerank_model)
+llm_tokenizer = f"{model_type}:{os.path.basename(model_path or '')}"  # identifies the tokenizer of the token counts stored in chunks
 
 
-def get_embedding_model() -> tuple[HuggingFaceEmbeddings | LlamaCppEmbeddings, Callable]:
+def get_embedding_model() -> tuple[HuggingFaceEmbeddings | LlamaCppPoolEmbeddings | HashEmbeddings, Callable]:
     """get the text embedding model
     :returns: tuple[the model, its encoding function]"""
     match text_embeddings_model_type:
@@ -45,14 +101,54 @@ def get_embedding_model() -> tuple[HuggingFaceEmbeddings | LlamaCppEmbeddings, C
             model = HuggingFaceEmbeddings(model_name=text_embeddings_model)
             return model, model.client.encode
         case "LlamaCpp":
-            model = LlamaCppEmbeddings(model_path=text_embeddings_model, n_ctx=model_n_ctx, n_gpu_layers=n_gpu_layers)
-            return model, lambda inpt: model.client.embed(inpt) if isinstance(inpt, str) else [
-                model.client.embed(e) for e in inpt
-            ]  # no batched embedding in llamacpp
+            model = LlamaCppPoolEmbeddings(
+                text_embeddings_model,
+                n_ctx=model_n_ctx,
+                n_gpu_layers=n_gpu_layers,
+                use_mlock=use_mlock,
+                n_contexts=text_embeddings_n_contexts,
+                batch_size=text_embeddings_batch_size,
+            )
+            return model, model.encode
+        case "Hash":  # no model, TEXT_EMBEDDINGS_MODEL is the vector size
+            model = HashEmbeddings(int(text_embeddings_model or 384))
+            return model, model.encode
         case _:
             raise ValueError(f"Unknown embedding type {text_embeddings_model_type}")
 
 
+def get_reranker() -> Reranker | None:
+    """get the reranker, None if disabled"""
+    return Reranker.load(rerank_model, rerank_batch_size, rerank_n_threads, rerank_min_score) if rerank_model else None
+
+
+def llama_token_length(llama: Any) -> Callable[[str], int]:
+    """a function counting tokens as llama-cpp-python tokenizes a completion's prompt: with a leading space and the BOS token"""
+    return lambda text: len(llama.tokenize(b" " + text.encode("utf-8")))
+
+
+def get_token_length(source: str) -> Callable[[str], int]:
+    """a function counting tokens with the tokenizer of the embedding model or of the LLM, without loading the model weights"""
+    model_kind, path = (text_embeddings_model_type, text_embeddings_model) if source == "embedding" else (model_type, model_path)
+    match model_kind:
+        case "HF":
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(path)
+            return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+        case "LlamaCpp":
+            from llama_cpp import Llama
+
+            llama = Llama(model_path=path, vocab_only=True, verbose=False)
+            if source == "llm":  # counted like the QA chains count them, so that the sizes stored in chunks match
+                return llama_token_length(llama)
+            return lambda text: len(llama.tokenize(text.encode("utf-8"), add_bos=False))
+        case "Hash":
+            return lambda text: len(text.split())
+        case _:
+            raise ValueError(f"No tokenizer available for {source} model type {model_kind}")
+
+
 def get_prompt_template_kwargs() -> dict[str, PromptTemplate]:
     """get an improved prompt template"""
     match chain_type:
@@ -0,0 +1,115 @@
+"""persistent record of ingested files, used to only re-ingest what changed"""
+import json
+import os
+from hashlib import md5
+from pathlib import Path
+
+
+def file_hash(filepath: Path, block_size: int = 2**20) -> str:
+    """md5 of a file's content, read by blocks"""
+    h = md5()
+    with open(filepath, "rb") as f:
+        while block := f.read(block_size):
+            h.update(block)
+    return h.hexdigest()
+
+
+class IngestManifest:
+    """per-file manifest of what is stored in a collection
+    Each entry is keyed by the absolute file path and holds its size, mtime, content hash, the IDs of its chunks, and the ingestion settings used.
+    During ingestion, stored files are checkpointed by appending them to a journal, which is merged into the manifest by save().
+    """
+
+    def __init__(self, db_dir: str, collection: str, settings: dict):
+        self.path = self.manifest_path(db_dir, collection)
+        self.journal_path = self.path.with_suffix(".journal")
+        self.settings = settings
+        self.entries: dict[str, dict] = {}
+        self.recorded: dict[str, dict] = {}  # recorded but not checkpointed yet
+        if Path(db_dir).exists():  # a manifest without its db is stale
+            self.load()
+
+    def load(self) -> None:
+        """load the manifest, then replay the journal of an interrupted ingestion"""
+        if self.path.exists():
+            with open(self.path, encoding="utf8") as f:
+                self.entries = json.load(f)
+        if not self.journal_path.exists():
+            return
+        with open(self.journal_path, encoding="utf8") as f:
+            for line in f:
+                try:
+                    self.entries |= json.loads(line)
+                except json.JSONDecodeError:  # last line cut by a crash, the file wasn't checkpointed
+                    break
+
+    @staticmethod
+    def manifest_path(db_dir: str, collection: str) -> Path:
+        """where the manifest of a collection lives, next to the db directory"""
+        db_dir = Path(db_dir)
+        return db_dir.with_name(f"{db_dir.name}.{collection}.manifest.json")
+
+    @staticmethod
+    def stat(filepath: Path) -> dict:
+        """the cheap part of an entry"""
+        st = filepath.stat()
+        return {"size": st.st_size, "mtime": st.st_mtime}
+
+    def is_unchanged(self, key: str, filepath: Path) -> bool:
+        """whether a file is already stored with the current settings. Only hashes the file if its size or mtime changed."""
+        entry = self.entries.get(key)
+        if entry is None or entry["settings"] != self.settings:
+            return False
+        stat = self.stat(filepath)
+        if stat["size"] == entry["size"] and stat["mtime"] == entry["mtime"]:
+            return True
+        if stat["size"] != entry["size"] or file_hash(filepath) != entry["hash"]:
+            return False
+        entry.update(stat)  # touched but not modified
+        return True
+
+    def record(self, key: str, filepath: Path, ids: list[str]) -> None:
+        """record a file as fully stored. It's only persisted by checkpoint() or save()."""
+        try:
+            stat, digest = self.stat(filepath), file_hash(filepath)
+        except FileNotFoundError:  # deleted since it was loaded: its chunks are still recorded, to be removed with the entry
+            stat, digest = {"size": -1, "mtime": 0}, ""
+        self.entries[key] = self.recorded[key] = {**stat, "hash": digest, "ids": ids, "settings": self.settings}
+
+    def checkpoint(self) -> None:
+        """append the recorded files to the journal, one line each, and sync it to disk"""
+        if not self.recorded:
+            return
+        with open(self.journal_path, "a", encoding="utf8") as f:
+            f.write("".join(json.dumps({key: entry}) + "\n" for key, entry in self.recorded.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        self.recorded = {}
+
+    def unreferenced_ids(self, keys: list[str]) -> list[str]:
+        """the chunk IDs of entries that no other file references, i.e. to delete from the store before forgetting these entries"""
+        keys = set(keys)
+        ids = {i for key in keys if key in self.entries for i in self.entries[key]["ids"]}
+        still_used = {i for key, entry in self.entries.items() if key not in keys for i in entry["ids"]}
+        return list(ids - still_used)
+
+    def forget(self, keys: list[str]) -> None:
+        """remove entries"""
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def keys_under(self, root: Path) -> list[str]:
+        """entries located in a directory"""
+        root = str(root.resolve())
+        return [key for key in self.entries if key == root or key.startswith(root + os.sep)]
+
+    def save(self) -> None:
+        """write the whole manifest to disk atomically, and clear the journal"""
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self.entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.journal_path.unlink(missing_ok=True)
+        self.recorded = {}
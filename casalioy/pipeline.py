@@ -0,0 +1,56 @@
+"""bounded hand-offs between the stages of the ingestion pipeline"""
+import threading
+from typing import Any, Callable, Iterable, Iterator
+
+
+class Backpressure:
+    """limits how many items can be in flight between a producer and a consumer
+    The producer side is a generator fed to a pool's imap, which blocks once max_in_flight items have been submitted and not yet consumed.
+    The consumer side wraps the imap results and frees a slot for each item it takes.
+    """
+
+    def __init__(self, max_in_flight: int, stop: threading.Event):
+        self.max_in_flight = max_in_flight
+        self.slots = threading.Semaphore(max_in_flight)
+        self.stop = stop
+        self.in_flight = self.max_depth = 0  # for reporting only
+
+    def release(self) -> None:
+        """free a slot"""
+        self.in_flight -= 1
+        self.slots.release()
+
+    def feed(self, iterable: Iterable) -> Iterator:
+        """yield items from iterable, waiting for a free slot before each one"""
+        for item in iterable:
+            while not self.slots.acquire(timeout=1):
+                if self.stop.is_set():  # the pipeline is being torn down
+                    return
+            self.in_flight += 1
+            self.max_depth = max(self.max_depth, self.in_flight)
+            yield item
+
+    def drain(self, results: Iterator, transform: Callable[[Any], Any] = None) -> "Drained":
+        """wrap results so that each consumed item frees a slot
+        :param transform: applied to each result"""
+        return Drained(results, self, transform)
+
+
+class Drained:
+    """results of a pool's imap, freeing a Backpressure slot for each consumed item"""
+
+    def __init__(self, results: Iterator, backpressure: Backpressure, transform: Callable[[Any], Any] = None):
+        self.results = results
+        self.backpressure = backpressure
+        self.transform = transform or (lambda item: item)
+
+    def next(self, timeout: float = None) -> Any:
+        """same as IMapIterator.next"""
+        item = self.results.next(timeout=timeout)
+        self.backpressure.release()
+        return self.transform(item)
+
+    __next__ = next
+
+    def __iter__(self) -> "Drained":
+        return self
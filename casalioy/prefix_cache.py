@@ -0,0 +1,59 @@
+"""reuse the llama.cpp state of the instructions which start a prompt template across queries"""
+from collections import OrderedDict
+from string import Formatter
+from typing import Any, Sequence
+
+from langchain import PromptTemplate
+
+
+def common_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    """number of leading tokens two sequences share"""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class PrefixCache:
+    """llama.cpp states saved after evaluating the static beginning of prompt templates, i.e. the text before their first variable.
+    Loading one before a completion leaves only the question and extracts to evaluate: llama-cpp-python reuses the evaluated
+    tokens which start the prompt. States are keyed by model and prefix, so a changed template or model gets a new one, and
+    only the capacity most recently used are kept: each holds the KV cache of the whole context.
+    """
+
+    def __init__(self, llama: Any, model_path: str, capacity: int = 2):
+        self.llama = llama
+        self.model_path = model_path
+        self.capacity = capacity
+        self.states: OrderedDict[tuple[str, str], Any] = OrderedDict()
+
+    @staticmethod
+    def static_prefix(template: PromptTemplate) -> str:
+        """the text of a template before its first variable"""
+        prefix = ""
+        for literal, field, _, _ in Formatter().parse(template.template):
+            prefix += literal
+            if field is not None:
+                break
+        return prefix
+
+    def tokenize(self, text: str) -> list[int]:
+        """tokens of a prompt, as llama-cpp-python tokenizes it for a completion"""
+        return self.llama.tokenize(b" " + text.encode("utf-8"))
+
+    def restore(self, template: PromptTemplate, prompt: str) -> None:
+        """load the state of the template's prefix, evaluated the first time, unless the context already holds more of the prompt"""
+        key = (self.model_path, self.static_prefix(template))
+        if key not in self.states:
+            tokens = self.tokenize(key[1])[:-1]  # the last token may merge with the text following the prefix
+            self.llama.reset()
+            self.llama.eval(tokens)
+            self.states[key] = self.llama.save_state()
+            while len(self.states) > self.capacity:
+                self.states.popitem(last=False)
+        self.states.move_to_end(key)
+        state, tokens = self.states[key], self.tokenize(prompt)
+        if common_prefix(state.eval_tokens, tokens) > common_prefix(self.llama.eval_tokens, tokens):
+            self.llama.load_state(state)
@@ -0,0 +1,76 @@
+"""reduce the dimension of embeddings, by PCA or by truncation"""
+from pathlib import Path
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from casalioy.utils import collection_path
+
+
+class Projection:
+    """linear projection of embeddings to fewer dimensions, followed by a normalization since the store uses the cosine distance
+    "pca" projects on the principal components of a sample of the collection's embeddings. They are computed without centering
+    the sample, so that the projection preserves the dot products (and not the distances to the mean) as well as possible.
+    "truncate" keeps the first dimensions, which only works well for models trained for it (Matryoshka embeddings).
+    """
+
+    def __init__(self, kind: str, dim: int, components: np.ndarray | None = None):
+        self.kind = kind
+        self.dim = dim
+        self.components = components  # (dim, input dim) for pca
+
+    @classmethod
+    def fit(cls, kind: str, dim: int, sample: np.ndarray) -> "Projection":
+        """the projection of the given kind, fitted on a sample of embeddings for pca"""
+        sample = np.asarray(sample, dtype=np.float32)
+        if dim > sample.shape[1]:
+            raise ValueError(f"Cannot reduce {sample.shape[1]}-dimensional embeddings to {dim} dimensions")
+        match kind:
+            case "truncate":
+                return cls(kind, dim)
+            case "pca":
+                if len(sample) < dim:
+                    raise ValueError(f"A PCA to {dim} dimensions needs at least {dim} embeddings to be fitted on, got {len(sample)}")
+                _, _, vt = np.linalg.svd(sample, full_matrices=False)
+                return cls(kind, dim, vt[:dim])
+            case _:
+                raise ValueError(f"Unknown dimensionality reduction {kind}")
+
+    def __call__(self, vectors: np.ndarray) -> np.ndarray:
+        """project and normalize embeddings"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        reduced = vectors[..., : self.dim] if self.kind == "truncate" else vectors @ self.components.T
+        norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+        return reduced / np.where(norms == 0, 1, norms)
+
+    @staticmethod
+    def path_for(db_dir: str, collection: str) -> Path:
+        """where the projection of a collection is kept"""
+        return collection_path(db_dir, f"projection.{collection}.npz")
+
+    def save(self, path: Path) -> None:
+        """write the projection, with its kind and dimension"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, kind=self.kind, dim=self.dim, **({"components": self.components} if self.kind == "pca" else {}))
+
+    @classmethod
+    def load(cls, path: Path) -> "Projection | None":
+        """the projection saved at path, None if there is none"""
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            return cls(str(data["kind"]), int(data["dim"]), data.get("components"))
+
+
+class ProjectedEmbeddings(Embeddings):
+    """embeddings of a model, projected like the collection they are searched in"""
+
+    def __init__(self, embeddings: Embeddings, projection: Projection):
+        self.embeddings = embeddings
+        self.projection = projection
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.projection(np.asarray(self.embeddings.embed_documents(texts))).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.projection(np.asarray(self.embeddings.embed_query(text))).tolist()
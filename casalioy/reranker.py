@@ -0,0 +1,46 @@
+"""rerank the retrieved chunks with a local cross-encoder"""
+from typing import Any
+
+import numpy as np
+from langchain.schema import Document
+
+
+class Reranker:
+    """scores (question, chunk) pairs with a cross-encoder, which reads both texts together: much more accurate than the
+    similarity of their embeddings, but too slow for the whole collection, so it only reorders the candidates of a search.
+    The pairs are scored by batches of batch_size on the CPU, with n_threads torch threads (0 keeps torch's default).
+    """
+
+    def __init__(self, model: Any, batch_size: int = 32, min_score: float = float("-inf")):
+        self.model = model  # anything with the predict method of sentence_transformers' CrossEncoder
+        self.batch_size = batch_size
+        self.min_score = min_score
+
+    @classmethod
+    def load(cls, model_name: str, batch_size: int = 32, n_threads: int = 0, min_score: float = float("-inf")) -> "Reranker":
+        """the reranker of a sentence_transformers cross-encoder model"""
+        try:
+            import torch
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:  # torch isn't installed by poetry with sentence_transformers
+            raise ImportError(f"RERANK_MODEL needs sentence_transformers and torch ({e}): pip install sentence-transformers torch") from e
+
+        if n_threads:
+            torch.set_num_threads(n_threads)
+        return cls(CrossEncoder(model_name, device="cpu"), batch_size, min_score)
+
+    def scores(self, query: str, documents: list[Document]) -> np.ndarray:
+        """relevance of each document to the query, as the model's logits"""
+        if not documents:
+            return np.empty(0, dtype=np.float32)
+        pairs = [(query, document.page_content) for document in documents]
+        return np.asarray(self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False), dtype=np.float32).reshape(len(documents))
+
+    def rerank(self, query: str, documents: list[Document], k: int) -> list[Document]:
+        """the k documents most relevant to the query, with their score as "rerank_score" metadata.
+        Those scoring below min_score are dropped, but the best one is always kept."""
+        scores = self.scores(query, documents)
+        order = np.argsort(-scores, kind="stable")[:k]
+        for i in order:
+            documents[i].metadata["rerank_score"] = float(scores[i])
+        return [documents[i] for i in order if scores[i] >= self.min_score] or [documents[i] for i in order[:1]]
@@ -0,0 +1,24 @@
+"""SQLite helpers shared by the on-disk stores (docstore, embedding cache)"""
+import sqlite3
+from pathlib import Path
+from typing import Iterator
+
+mmap_size = 2**30
+max_variables = 500  # per query, below sqlite's limit
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """a connection in autocommit mode, with WAL journaling so that several processes can read while one writes,
+    and memory-mapped reads"""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(path, timeout=60, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(f"PRAGMA mmap_size={mmap_size}")
+    return db
+
+
+def in_clauses(keys: list[str]) -> Iterator[tuple[list[str], str]]:
+    """keys by parts small enough to be bound in a query, each with the placeholders of its IN clause"""
+    for i in range(0, len(keys), max_variables):
+        part = keys[i : i + max_variables]
+        yield part, ",".join("?" * len(part))
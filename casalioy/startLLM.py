@@ -1,19 +1,25 @@
 """start the local LLM"""
+import os
+import time
 
-import qdrant_client
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain.chains import RetrievalQA
 from langchain.embeddings.base import Embeddings
-from langchain.vectorstores import Qdrant
+from langchain.llms.base import LLM
 from prompt_toolkit import PromptSession
 from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
 from prompt_toolkit.formatted_text.html import html_escape
 
-from casalioy.CustomChains import RefineQA, StuffQA
+from casalioy.CustomChains import MapReduceQA, RefineQA, StuffQA
+from casalioy.docstore import DocStore
 from casalioy.load_env import (
     chain_type,
+    chunk_docstore,
     get_embedding_model,
     get_prompt_template_kwargs,
+    get_reranker,
+    llama_token_length,
+    mapreduce_n_workers,
     model_max_tokens,
     model_n_ctx,
     model_path,
@@ -26,7 +32,56 @@ from casalioy.load_env import (
     persist_directory,
     use_mlock,
 )
+from casalioy.projection import ProjectedEmbeddings, Projection
 from casalioy.utils import print_HTML, prompt_HTML
+from casalioy.vector_store import IndexStore, StoreBusyError, open_index
+
+
+def get_llm(
+    model_path: str,
+    n_ctx: int,
+    model_temp: float,
+    stop: list[str],
+    use_mlock: bool,
+    n_gpu_layers: int,
+    callbacks: list | None = None,
+    n_threads: int = 6,
+    verbose: bool = True,
+) -> LLM:
+    """the configured LLM"""
+    match model_type:
+        case "LlamaCpp":
+            from langchain.llms import LlamaCpp
+
+            llm = LlamaCpp(
+                model_path=model_path,
+                n_ctx=n_ctx,
+                temperature=model_temp,
+                stop=stop,
+                callbacks=callbacks,
+                verbose=verbose,
+                n_threads=n_threads,
+                n_batch=1000,
+                use_mlock=use_mlock,
+                n_gpu_layers=n_gpu_layers,
+                max_tokens=model_max_tokens,
+            )
+            # Fix wrong default
+            object.__setattr__(llm, "get_num_tokens", llama_token_length(llm.client))
+            return llm
+
+        case "GPT4All":
+            from langchain.llms import GPT4All
+
+            return GPT4All(
+                model=model_path,
+                n_ctx=n_ctx,
+                callbacks=callbacks,
+                verbose=verbose,
+                backend="gptj",
+            )
+        case _:
+            raise ValueError("Only LlamaCpp or GPT4All supported right now. Make sure you set up your .env correctly.")
 
 
 class QASystem:
@@ -45,50 +100,26 @@ class QASystem:
         collection="test",
     ):
         # Get embeddings and local vector store
-        self.qdrant_client = qdrant_client.QdrantClient(path=db_path, prefer_grpc=True)
-        self.qdrant_langchain = Qdrant(client=self.qdrant_client, collection_name=collection, embeddings=embeddings)
+        self.index = open_index(db_path, collection, read_only=True)
+        if projection := Projection.load(Projection.path_for(db_path, collection)):  # queries are reduced like the collection
+            embeddings = ProjectedEmbeddings(embeddings, projection)
+        docstore = DocStore(DocStore.path_for(db_path, collection)) if chunk_docstore else None
+        self.vector_store = IndexStore(self.index, embeddings, docstore)
 
         # Prepare the LLM chain
-        callbacks = [StreamingStdOutCallbackHandler()]
-        match model_type:
-            case "LlamaCpp":
-                from langchain.llms import LlamaCpp
-
-                llm = LlamaCpp(
-                    model_path=model_path,
-                    n_ctx=n_ctx,
-                    temperature=model_temp,
-                    stop=stop,
-                    callbacks=callbacks,
-                    verbose=True,
-                    n_threads=6,
-                    n_batch=1000,
-                    use_mlock=use_mlock,
-                    n_gpu_layers=n_gpu_layers,
-                    max_tokens=model_max_tokens,
-                )
-                # Fix wrong default
-                object.__setattr__(llm, "get_num_tokens", lambda text: len(llm.client.tokenize(b" " + text.encode("utf-8"))))
-
-            case "GPT4All":
-                from langchain.llms import GPT4All
-
-                llm = GPT4All(
-                    model=model_path,
-                    n_ctx=n_ctx,
-                    callbacks=callbacks,
-                    verbose=True,
-                    backend="gptj",
-                )
-            case _:
-                raise ValueError("Only LlamaCpp or GPT4All supported right now. Make sure you set up your .env correctly.")
-
+        llm_kwargs = {"model_path": model_path, "n_ctx": n_ctx, "model_temp": model_temp, "stop": stop, "use_mlock": use_mlock, "n_gpu_layers": n_gpu_layers}
+        llm = get_llm(**llm_kwargs, callbacks=[StreamingStdOutCallbackHandler()])
         self.llm = llm
-        retriever = self.qdrant_langchain.as_retriever(search_type="mmr")
+        retriever = self.vector_store.as_retriever(search_type="mmr")
+        reranker = get_reranker() if chain_type.startswith("better") else None
         if chain_type == "betterstuff":
-            self.qa = StuffQA(retriever=retriever, llm=self.llm)
+            self.qa = StuffQA(retriever=retriever, llm=self.llm, reranker=reranker)
         elif chain_type == "betterrefine":
-            self.qa = RefineQA(retriever=retriever, llm=self.llm)
+            self.qa = RefineQA(retriever=retriever, llm=self.llm, reranker=reranker)
+        elif chain_type == "bettermapreduce":  # the map calls run on their own contexts, without streaming, so that they can run concurrently
+            n_threads = max((os.cpu_count() or 1) // mapreduce_n_workers, 1)
+            workers = [get_llm(**llm_kwargs, n_threads=n_threads, verbose=False) for _ in range(mapreduce_n_workers)]
+            self.qa = MapReduceQA(retriever=retriever, llm=self.llm, workers=workers, reranker=reranker)
         else:
             self.qa = RetrievalQA.from_chain_type(
                 llm=self.llm,
@@ -99,10 +130,28 @@ class QASystem:
             )
         self.qa.retriever.search_kwargs = {**self.qa.retriever.search_kwargs, "k": n_forward_documents, "fetch_k": n_retrieve_documents}
 
+    def ask(self, query: str, busy_timeout: float = 60) -> dict:
+        """run the chain, waiting while ingest is writing to the local store.
+        The store is released afterwards, so that ingest --watch can write to it until the next query."""
+        deadline, waiting = time.monotonic() + busy_timeout, False
+        try:
+            while True:
+                try:
+                    return self.qa(query)
+                except StoreBusyError:  # raised when opening the store, before the LLM is called
+                    if time.monotonic() > deadline:
+                        raise
+                    if not waiting:
+                        print_HTML("<r>The vector store is being written by ingest, waiting...</r>")
+                    waiting = True
+                    time.sleep(1)
+        finally:
+            self.index.close()
+
     def prompt_once(self, query: str) -> tuple[str, str]:
         """run a prompt"""
         # Get the answer from the chain
-        res = self.qa(query)
+        res = self.ask(query)
         answer, docs = res["result"], res["source_documents"]
 
         # Print the result
@@ -128,7 +177,10 @@ def main() -> None:
         elif not query:  # check if query empty
             print_HTML("<r>Empty query, skipping</r>")
             continue
-        qa_system.prompt_once(query)
+        try:
+            qa_system.prompt_once(query)
+        except StoreBusyError:
+            print_HTML("<w>The vector store is still being written by ingest, try again later</w>")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+"""throughput and latency statistics of the ingestion stages"""
+import heapq
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from casalioy.archives import is_archive
+from casalioy.pipeline import Backpressure
+
+
+class IngestStats:
+    """thread-safe counters and timers for each ingestion stage (load, split, embed, store)
+    Written as a JSON report at the end of the ingestion, and optionally as periodic snapshots while it runs.
+    """
+
+    stages = ("load", "split", "embed", "store")
+
+    def __init__(self, path: str, interval: float = 0, n_slowest: int = 10):
+        self.path = path
+        self.interval = interval
+        self.n_slowest = n_slowest
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.counters = {stage: {"seconds": 0.0, "calls": 0, "files": 0, "chunks": 0, "bytes": 0} for stage in self.stages}
+        self.batch_sizes = {"count": 0, "total": 0, "min": None, "max": None}
+        self.slowest: list[tuple[float, str]] = []  # min-heap of (seconds, file)
+        self.queues: dict[str, Backpressure] = {}
+        self.done = threading.Event()
+
+    def add(self, stage: str, seconds: float, files: int = 0, chunks: int = 0, n_bytes: int = 0) -> None:
+        """account for one call of a stage"""
+        with self.lock:
+            counter = self.counters[stage]
+            counter["seconds"] += seconds
+            counter["calls"] += 1
+            counter["files"] += files
+            counter["chunks"] += chunks
+            counter["bytes"] += n_bytes
+
+    def loaded(self, result: tuple) -> tuple:
+        """account for a load task's timings, return its result without them"""
+        task, chunks, timings = result
+        filepath, pages, part, _, _ = task
+        self.add("load", timings["load"], files=int(part == 0), n_bytes=timings["bytes"])
+        self.add("split", timings["split"], chunks=len(chunks))
+        name = str(filepath) if pages is None else f"{filepath} ({'members' if is_archive(filepath) else 'pages'} {pages.start + 1}-{pages.stop})"
+        with self.lock:
+            heapq.heappush(self.slowest, (timings["load"] + timings["split"], name))
+            if len(self.slowest) > self.n_slowest:
+                heapq.heappop(self.slowest)
+        return task, chunks
+
+    def embedded(self, result: tuple) -> tuple:
+        """account for an embedding batch's timings, return its result without them"""
+        embedded_batch, timings = result
+        n_chunks = len(embedded_batch[1])
+        self.add("embed", timings["embed"], files=len(embedded_batch[0]), chunks=n_chunks)
+        with self.lock:
+            sizes = self.batch_sizes
+            sizes["count"] += 1
+            sizes["total"] += n_chunks
+            sizes["min"] = n_chunks if sizes["min"] is None else min(sizes["min"], n_chunks)
+            sizes["max"] = n_chunks if sizes["max"] is None else max(sizes["max"], n_chunks)
+        return embedded_batch
+
+    def watch_queue(self, name: str, backpressure: Backpressure) -> Backpressure:
+        """report the depth of a queue"""
+        self.queues[name] = backpressure
+        return backpressure
+
+    def report(self) -> dict:
+        """the current statistics"""
+        with self.lock:
+            elapsed = time.monotonic() - self.start
+            stages = {}
+            for stage, counter in self.counters.items():
+                rates = {f"{k}_per_s": counter[k] / elapsed if elapsed else 0 for k in ("files", "chunks", "bytes")}
+                stages[stage] = {**counter, **rates, "seconds_per_call": counter["seconds"] / counter["calls"] if counter["calls"] else 0}
+            queues = {}
+            for name, backpressure in self.queues.items():
+                queues[name] = {"depth": backpressure.in_flight, "max_depth": backpressure.max_depth, "capacity": backpressure.max_in_flight}
+            sizes = self.batch_sizes
+            return {
+                "running": not self.done.is_set(),
+                "elapsed_seconds": elapsed,
+                "stages": stages,
+                "queues": queues,
+                "embedding_batch_sizes": {**sizes, "mean": sizes["total"] / sizes["count"] if sizes["count"] else 0},
+                "slowest_files": [{"file": name, "seconds": seconds} for seconds, name in sorted(self.slowest, reverse=True)],
+            }
+
+    def write(self) -> None:
+        """write the report atomically"""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def snapshot_loop(self) -> None:
+        """write a snapshot every interval until done"""
+        while not self.done.wait(self.interval):
+            self.write()
+
+    def __enter__(self) -> "IngestStats":
+        self.start = time.monotonic()
+        if self.path and self.interval > 0:
+            threading.Thread(target=self.snapshot_loop, daemon=True).start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.done.set()
+        self.write()
+
+    @property
+    def profile_dir(self) -> Path:
+        """where the workers' profiles are written"""
+        return Path(self.path or "ingest_stats").with_suffix(".profile")
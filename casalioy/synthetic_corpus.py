@@ -0,0 +1,182 @@
+"""generate a deterministic synthetic corpus of documents, in the formats handled by the ingester"""
+import csv
+import io
+import random
+import zipfile
+from email.message import EmailMessage
+from html import escape
+from pathlib import Path
+from typing import Callable
+
+words = (
+    "the of and to in is was for on that with as by at from this be are or an it not which have has but were all their they one been "
+    "its more also new other some time first two after into only would years may most over such when these than many between made "
+    "system data model document report energy water market policy health river city history language network process method result "
+    "analysis design engine power light sound music table value growth budget court law trade state union nation people company "
+    "service project school student research science theory number signal memory vector index query answer question source"
+).split()
+boilerplate = "This message and any attachments are confidential and intended solely for the addressee. If you received it in error, delete it."
+
+
+def escape_pdf(text: str) -> str:
+    """text as a PDF string literal, without its parentheses"""
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+class SyntheticCorpus:
+    """deterministic documents of a given size, with some repeated boilerplate as real corpora have
+    Binary formats which can't be written without their own libraries (doc, ppt, pptx, msg) are not generated.
+    """
+
+    def __init__(self, seed: int = 0):
+        self.rng = random.Random(seed)
+
+    def sentence(self) -> str:
+        """a random sentence"""
+        sentence = " ".join(self.rng.choice(words) for _ in range(self.rng.randint(6, 20)))
+        return sentence[0].upper() + sentence[1:] + "."
+
+    def paragraphs(self, size: int) -> list[str]:
+        """paragraphs totalling about size characters"""
+        paragraphs, total = [], 0
+        while total < size:
+            paragraph = " ".join(self.sentence() for _ in range(self.rng.randint(3, 8)))
+            if self.rng.random() < 0.2:
+                paragraph += " " + boilerplate
+            paragraphs.append(paragraph)
+            total += len(paragraph) + 2
+        return paragraphs
+
+    @property
+    def writers(self) -> dict[str, Callable[[Path, list[str]], None]]:
+        """extension -> function writing paragraphs to a file"""
+        return {
+            "txt": self.write_txt,
+            "md": self.write_md,
+            "csv": self.write_csv,
+            "html": self.write_html,
+            "eml": self.write_eml,
+            "pdf": self.write_pdf,
+            "docx": self.write_docx,
+            "epub": self.write_epub,
+        }
+
+    def generate(self, directory: Path, formats: list[str], n_files: int, size: int) -> list[Path]:
+        """write n_files of about size characters in each format"""
+        directory.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for ext in formats:
+            for i in range(n_files):
+                path = directory / ext / f"doc_{i:05d}.{ext}"
+                path.parent.mkdir(exist_ok=True)
+                self.writers[ext](path, self.paragraphs(size))
+                paths.append(path)
+        return paths
+
+    @staticmethod
+    def write_txt(path: Path, paragraphs: list[str]) -> None:
+        path.write_text("\n\n".join(paragraphs), encoding="utf8")
+
+    @staticmethod
+    def write_md(path: Path, paragraphs: list[str]) -> None:
+        path.write_text("\n\n".join(f"## Section {i + 1}\n\n{p}" for i, p in enumerate(paragraphs)), encoding="utf8")
+
+    @staticmethod
+    def write_csv(path: Path, paragraphs: list[str]) -> None:
+        with open(path, "w", newline="", encoding="utf8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "title", "text"])
+            writer.writerows([i, " ".join(p.split()[:4]), p] for i, p in enumerate(paragraphs))
+
+    @staticmethod
+    def write_html(path: Path, paragraphs: list[str]) -> None:
+        body = "".join(f"<p>{escape(p)}</p>\n" for p in paragraphs)
+        path.write_text(f"<!DOCTYPE html>\n<html><head><title>{path.stem}</title></head><body>\n{body}</body></html>\n", encoding="utf8")
+
+    @staticmethod
+    def write_eml(path: Path, paragraphs: list[str]) -> None:
+        message = EmailMessage()
+        message["Subject"], message["From"], message["To"] = path.stem, "sender@example.com", "recipient@example.com"
+        message.set_content("\n\n".join(paragraphs))
+        path.write_bytes(bytes(message))
+
+    @staticmethod
+    def write_pdf(path: Path, paragraphs: list[str], lines_per_page: int = 60, line_width: int = 95) -> None:
+        """a minimal PDF with one Helvetica text stream per page"""
+        lines = []
+        for paragraph in paragraphs:
+            line = ""
+            for word in paragraph.split():
+                if len(line) + len(word) >= line_width:
+                    lines.append(line)
+                    line = ""
+                line += f"{word} "
+            lines += [line, ""]
+        pages = [lines[i : i + lines_per_page] for i in range(0, len(lines), lines_per_page)]
+
+        n_pages = len(pages)
+        kids = " ".join(f"{4 + 2 * i} 0 R" for i in range(n_pages))
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            f"<< /Type /Pages /Kids [{kids}] /Count {n_pages} >>".encode(),
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        ]
+        for i, page in enumerate(pages):
+            stream = ("BT /F1 10 Tf 12 TL 50 800 Td " + " ".join(f"({escape_pdf(line)}) Tj T*" for line in page) + " ET").encode("latin-1")
+            objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>".encode())
+            objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+        out, offsets = io.BytesIO(), []
+        out.write(b"%PDF-1.4\n")
+        for i, obj in enumerate(objects):
+            offsets.append(out.tell())
+            out.write(b"%d 0 obj\n" % (i + 1) + obj + b"\nendobj\n")
+        xref = out.tell()
+        out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1) + b"".join(b"%010d 00000 n \n" % o for o in offsets))
+        out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+        path.write_bytes(out.getvalue())
+
+    @staticmethod
+    def write_docx(path: Path, paragraphs: list[str]) -> None:
+        """a minimal Word document"""
+        ns = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+        body = "".join(f"<w:p><w:r><w:t>{escape(p)}</w:t></w:r></w:p>" for p in paragraphs)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr(
+                "[Content_Types].xml",
+                '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+                "</Types>",
+            )
+            z.writestr(
+                "_rels/.rels",
+                '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+                "</Relationships>",
+            )
+            z.writestr("word/document.xml", f'<?xml version="1.0" encoding="UTF-8"?><w:document xmlns:w="{ns}"><w:body>{body}</w:body></w:document>')
+
+    @staticmethod
+    def write_epub(path: Path, paragraphs: list[str]) -> None:
+        """a minimal EPUB with a single chapter"""
+        body = "".join(f"<p>{escape(p)}</p>" for p in paragraphs)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+            z.writestr(
+                "META-INF/container.xml",
+                '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                '<rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>',
+            )
+            z.writestr(
+                "content.opf",
+                '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">'
+                f'<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>{path.stem}</dc:title><dc:identifier id="id">{path.stem}</dc:identifier>'
+                "<dc:language>en</dc:language></metadata>"
+                '<manifest><item id="c1" href="chapter.xhtml" media-type="application/xhtml+xml"/></manifest><spine><itemref idref="c1"/></spine></package>',
+            )
+            z.writestr(
+                "chapter.xhtml",
+                f'<?xml version="1.0"?><html xmlns="http://www.w3.org/1999/xhtml"><head><title>{path.stem}</title></head><body>{body}</body></html>',
+            )
@@ -0,0 +1,66 @@
+"""single-pass text splitter, sizing chunks in characters or tokens"""
+from typing import Callable, Iterator
+
+from langchain.text_splitter import TextSplitter
+
+
+class FastTextSplitter(TextSplitter):
+    """same chunk_size/chunk_overlap semantics as langchain's RecursiveCharacterTextSplitter, in a single pass over the text
+    Each chunk is cut after the last paragraph end that fits, else the last line end, sentence end, or word end, found with str.rfind.
+    The next chunk starts at the first word within chunk_overlap of the end of the previous one.
+    With token_length, sizes are counted in tokens: the window is estimated from the average characters per token, then checked by tokenizing the chunk.
+    """
+
+    separators = (("\n\n",), ("\n",), (". ", "! ", "? "), (" ",))  # by order of preference
+
+    def __init__(self, chunk_size: int, chunk_overlap: int, token_length: Callable[[str], int] | None = None):
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.token_length = token_length
+        self.chars_per_token = 4.0  # running estimate, in token mode
+
+    def find_cut(self, text: str, min_cut: int, limit: int) -> int:
+        """position right after the preferred separator ending in text[min_cut:limit], or limit if there is none"""
+        if limit >= len(text):
+            return len(text)
+        for separators in self.separators:
+            positions = [(text.rfind(sep, max(min_cut - len(sep) + 1, 0), limit), len(sep)) for sep in separators]
+            cut = max((position + length for position, length in positions if position != -1), default=-1)
+            if cut > min_cut:
+                return cut
+        return limit
+
+    def fit_tokens(self, text: str, start: int, min_cut: int) -> int:
+        """cut of the longest chunk starting at start which fits in chunk_size tokens, in a few tokenizations"""
+        cut = self.find_cut(text, min_cut, start + int(self._chunk_size * self.chars_per_token))
+        for _ in range(4):
+            n_tokens = max(self.token_length(text[start:cut]), 1)
+            self.chars_per_token = 0.9 * self.chars_per_token + 0.1 * (cut - start) / n_tokens
+            if n_tokens <= self._chunk_size:
+                if cut == len(text) or n_tokens > 0.9 * self._chunk_size:
+                    return cut
+                larger = self.find_cut(text, cut, start + int((cut - start) * self._chunk_size / n_tokens))
+                if larger == cut or self.token_length(text[start:larger]) > self._chunk_size:
+                    return cut
+                cut = larger
+            else:
+                cut = self.find_cut(text, min_cut, start + int((cut - start) * self._chunk_size / n_tokens * 0.95))
+        return cut
+
+    def iter_split(self, text: str) -> Iterator[str]:
+        """yield the chunks of a text"""
+        start, previous_cut = len(text) - len(text.lstrip()), 0
+        while start < len(text):
+            min_cut = max(start, previous_cut) + 1  # each chunk holds some new text
+            cut = self.fit_tokens(text, start, min_cut) if self.token_length else self.find_cut(text, min_cut, start + self._chunk_size)
+            if chunk := text[start:cut].strip():
+                yield chunk
+            if cut >= len(text):
+                return
+            # overlap: the whole words of this chunk within chunk_overlap of its end
+            overlap = int(self._chunk_overlap * (self.chars_per_token if self.token_length else 1))
+            word_start = text.find(" ", cut - overlap, cut) + 1 if overlap else 0
+            start, previous_cut = word_start if word_start > start else cut, cut
+            start += len(text[start:cut]) - len(text[start:cut].lstrip())  # skip leading whitespace
+
+    def split_text(self, text: str) -> list[str]:
+        return list(self.iter_split(text))
@@ -58,6 +58,11 @@ def prompt_HTML(session: PromptSession, prompt: str, **kwargs) -> str:
             print("[Could not properly parse text. This is a CASALIOY error, please open an issue.]", prompt, kwargs)
 
 
+def collection_path(db_dir: str, name: str) -> Path:
+    """where a file of a collection is kept: inside the db directory, so that deleting the db deletes it too"""
+    return Path(db_dir) / name
+
+
 def download_if_repo(path: str) -> str:
     """download model from HF if not local"""
     # check if dataset
@@ -0,0 +1,321 @@
+"""vector store backends and their collection settings, shared by ingestion and querying"""
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Iterable, Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+from qdrant_client import QdrantClient
+from qdrant_client.http import models
+
+from casalioy.docstore import DocStore
+from casalioy.load_env import (
+    mmr_lambda,
+    qdrant_hnsw_ef,
+    qdrant_hnsw_ef_construct,
+    qdrant_hnsw_m,
+    qdrant_on_disk_index,
+    qdrant_on_disk_payload,
+    qdrant_on_disk_vectors,
+    qdrant_quantization,
+    qdrant_quantization_always_ram,
+    qdrant_rescore,
+    qdrant_url,
+    vector_backend,
+)
+
+
+class StoreBusyError(RuntimeError):
+    """the local store is opened by another process"""
+
+
+def open_client(db_dir: str) -> QdrantClient:
+    """the Qdrant server at QDRANT_URL if set, else the local store in db_dir.
+    The local store keeps all vectors in RAM as float32, ignores the collection settings below, and can only be opened by one process at a time."""
+    if qdrant_url:
+        return QdrantClient(url=qdrant_url, prefer_grpc=True)
+    try:
+        return QdrantClient(path=db_dir, prefer_grpc=True)
+    except RuntimeError as e:
+        if "already accessed" in str(e):
+            raise StoreBusyError(str(e)) from e
+        raise
+
+
+def quantization_config(kind: str = qdrant_quantization, always_ram: bool = qdrant_quantization_always_ram) -> Any:
+    """scalar (int8, 4x smaller) or product (PQ, up to 64x smaller) quantization of the vectors, or None"""
+    match kind:
+        case "" | "none":
+            return None
+        case "scalar":
+            return models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=always_ram))
+        case "product":
+            if not hasattr(models, "ProductQuantization"):
+                raise ValueError("Product quantization needs qdrant-client>=1.2")
+            return models.ProductQuantization(product=models.ProductQuantizationConfig(compression=models.CompressionRatio.X16, always_ram=always_ram))
+        case _:
+            raise ValueError(f"Unknown quantization {kind}")
+
+
+def collection_config(
+    vector_size: int,
+    quantization: str = qdrant_quantization,
+    quantization_always_ram: bool = qdrant_quantization_always_ram,
+    on_disk_vectors: bool = qdrant_on_disk_vectors,
+    on_disk_payload: bool = qdrant_on_disk_payload,
+    on_disk_index: bool = qdrant_on_disk_index,
+    hnsw_m: int = qdrant_hnsw_m,
+    hnsw_ef_construct: int = qdrant_hnsw_ef_construct,
+) -> dict[str, Any]:
+    """keyword arguments of QdrantClient.recreate_collection"""
+    vector_params = {"size": vector_size, "distance": models.Distance.COSINE}
+    optimizers_config = None
+    if on_disk_vectors:
+        if "on_disk" in models.VectorParams.__fields__:
+            vector_params["on_disk"] = True
+        else:  # older servers memmap segments larger than this many kB
+            optimizers_config = models.OptimizersConfigDiff(memmap_threshold=20_000)
+    return {
+        "vectors_config": models.VectorParams(**vector_params),
+        "hnsw_config": models.HnswConfigDiff(m=hnsw_m, ef_construct=hnsw_ef_construct, on_disk=on_disk_index),
+        "quantization_config": quantization_config(quantization, quantization_always_ram),
+        "optimizers_config": optimizers_config,
+        "on_disk_payload": on_disk_payload,
+    }
+
+
+def get_search_params(hnsw_ef: int | None = qdrant_hnsw_ef, rescore: bool = qdrant_rescore, exact: bool = False) -> models.SearchParams:
+    """search with the quantized vectors, then rescore the candidates with the original ones"""
+    return models.SearchParams(hnsw_ef=hnsw_ef, exact=exact, quantization=models.QuantizationSearchParams(rescore=rescore))
+
+
+def metadata_filter(filter: dict | None, prefix: str = "metadata") -> models.Filter | None:
+    """qdrant filter matching chunks whose metadata has these values, like langchain's"""
+    if not filter:
+        return None
+    conditions = []
+    for key, value in filter.items():
+        if isinstance(value, dict):
+            conditions += metadata_filter(value, f"{prefix}.{key}").must
+        else:
+            values = value if isinstance(value, list) else [value]
+            conditions += [models.FieldCondition(key=f"{prefix}.{key}", match=models.MatchValue(value=v)) for v in values]
+    return models.Filter(must=conditions)
+
+
+class VectorIndex(ABC):
+    """a collection of normalized vectors keyed by chunk ID, searched by cosine similarity: what ingestion and querying need from a backend.
+    Search results have the id, score, payload and vector attributes of qdrant's ScoredPoint.
+    """
+
+    has_payloads = True  # whether points can hold their chunk, else chunks are only in the docstore
+
+    @abstractmethod
+    def exists(self) -> bool:
+        """whether the collection exists"""
+
+    @abstractmethod
+    def create(self, vector_size: int) -> None:
+        """create the collection, replacing any previous one"""
+
+    @abstractmethod
+    def upsert(self, ids: list[str], vectors: list[list[float]], payloads: list[dict] | None) -> None:
+        """add or replace points, without payloads when the chunks are in the docstore"""
+
+    @abstractmethod
+    def delete(self, ids: list[str]) -> None:
+        """remove points"""
+
+    @abstractmethod
+    def set_metadata(self, metadatas: dict[str, dict]) -> None:
+        """replace the metadata in the payloads of points"""
+
+    @abstractmethod
+    def count(self) -> int:
+        """number of points"""
+
+    @abstractmethod
+    def drop(self) -> None:
+        """delete the collection"""
+
+    @abstractmethod
+    def search(self, vector: list[float], limit: int, with_payload: bool = True, with_vectors: bool = False, filter: dict | None = None) -> list[Any]:
+        """the limit points most similar to vector, by decreasing score"""
+
+    @abstractmethod
+    def retrieve(self, ids: list[str]) -> list[Any]:
+        """points with their payloads"""
+
+    def close(self) -> None:
+        """release the collection"""
+
+
+class QdrantIndex(VectorIndex):
+    """a collection of the Qdrant server or of the local store.
+    The client is opened on first use and released by close(), so that a process querying between long pauses (startLLM)
+    only holds the local store during each query, and ingest can write to it in between."""
+
+    def __init__(self, db_dir: str, collection: str, search_params: models.SearchParams | None = None):
+        self.db_dir = db_dir
+        self.collection = collection
+        self.search_params = search_params or get_search_params()
+        self._client = None
+
+    @property
+    def client(self) -> QdrantClient:
+        """the client, opened again after close()"""
+        if self._client is None:
+            self._client = open_client(self.db_dir)
+        return self._client
+
+    def exists(self) -> bool:
+        # get_collection raises a different error for a missing collection in local, REST and gRPC modes
+        return any(collection.name == self.collection for collection in self.client.get_collections().collections)
+
+    def create(self, vector_size: int) -> None:
+        self.client.recreate_collection(collection_name=self.collection, **collection_config(vector_size))
+
+    def upsert(self, ids: list[str], vectors: list[list[float]], payloads: list[dict] | None) -> None:
+        self.client.upsert(collection_name=self.collection, points=models.Batch.construct(ids=ids, vectors=vectors, payloads=payloads))
+
+    def delete(self, ids: list[str]) -> None:
+        self.client.delete(collection_name=self.collection, points_selector=models.PointIdsList(points=ids))
+
+    def set_metadata(self, metadatas: dict[str, dict]) -> None:
+        for chunk_id, metadata in metadatas.items():
+            self.client.set_payload(collection_name=self.collection, payload={"metadata": metadata}, points=[chunk_id])
+
+    def count(self) -> int:
+        return self.client.get_collection(self.collection).points_count
+
+    def drop(self) -> None:
+        self.client.delete_collection(self.collection)
+
+    def search(
+        self, vector: list[float], limit: int, with_payload: bool = True, with_vectors: bool = False, filter: dict | None = None
+    ) -> list[models.ScoredPoint]:
+        return self.client.search(
+            collection_name=self.collection,
+            query_vector=vector,
+            query_filter=metadata_filter(filter),
+            search_params=self.search_params,
+            with_payload=with_payload,
+            with_vectors=with_vectors,
+            limit=limit,
+        )
+
+    def retrieve(self, ids: list[str]) -> list[models.Record]:
+        return self.client.retrieve(self.collection, ids, with_payload=True)
+
+    def close(self) -> None:
+        if self._client is not None and hasattr(self._client, "close"):  # older clients release it on deletion
+            self._client.close()
+        self._client = None
+
+
+def open_index(db_dir: str, collection: str, read_only: bool = False, backend: str = vector_backend) -> VectorIndex:
+    """the collection in the configured backend. read_only lets processes query the ivf backend while another one writes to it."""
+    match backend:
+        case "qdrant":
+            return QdrantIndex(db_dir, collection)
+        case "ivf":
+            from casalioy.ivf_index import IVFIndex
+
+            return IVFIndex(IVFIndex.path_for(db_dir, collection), read_only=read_only)
+        case _:
+            raise ValueError(f"Unknown vector backend {backend}")
+
+
+def mmr_select(query: Any, vectors: Any, k: int, lambda_mult: float = mmr_lambda) -> list[int]:
+    """indices of k vectors chosen by maximal marginal relevance: each maximizes lambda_mult * its similarity to the query
+    - (1 - lambda_mult) * its highest similarity to those already chosen. Selects the same vectors as langchain's
+    maximal_marginal_relevance, with one matrix-vector product per step instead of a Python loop over the candidates."""
+    vectors, query = np.asarray(vectors), np.asarray(query)
+    if min(k, len(vectors)) <= 0:
+        return []
+    norms = np.linalg.norm(vectors, axis=1)
+
+    def similarities(vector: np.ndarray) -> np.ndarray:
+        """cosine similarities of the candidates to a vector, 0 for zero vectors as in langchain"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            similarity = (vectors @ vector) / (norms * np.linalg.norm(vector))
+        return np.where(np.isfinite(similarity), similarity, 0.0)
+
+    relevance = similarities(query)
+    selected = [int(np.argmax(relevance))]
+    redundancy = np.full(len(vectors), -np.inf)
+    available = np.ones(len(vectors), dtype=bool)
+    while len(selected) < min(k, len(vectors)):
+        available[selected[-1]] = False
+        redundancy = np.maximum(redundancy, similarities(vectors[selected[-1]]))
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        selected.append(int(np.argmax(scores)))
+    return selected
+
+
+class IndexStore(VectorStore):
+    """langchain vector store searching a VectorIndex, for the retrievers of the QA chains.
+    With a docstore, chunk texts are read from it, and only for the results: payloads aren't transferred during the search.
+    """
+
+    content_payload_key, metadata_payload_key = "page_content", "metadata"
+
+    def __init__(self, index: VectorIndex, embeddings: Embeddings, docstore: DocStore | None = None):
+        if docstore is None and not index.has_payloads:
+            raise ValueError(f"{type(index).__name__} keeps no payloads, it needs the docstore (CHUNK_DOCSTORE)")
+        self.index = index
+        self.embeddings = embeddings
+        self.docstore = docstore
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[list[dict]] = None, **kwargs: Any) -> list[str]:
+        raise NotImplementedError("Documents are added with ingest.py")
+
+    @classmethod
+    def from_texts(cls, texts: list[str], embedding: Embeddings, metadatas: Optional[list[dict]] = None, **kwargs: Any) -> "IndexStore":
+        raise NotImplementedError("Documents are added with ingest.py")
+
+    def search(self, query_vector: list[float], limit: int, with_payload: bool | None = None, **kwargs: Any) -> list[Any]:
+        """search the index, by default without payloads if they are in the docstore"""
+        return self.index.search(query_vector, limit, with_payload=self.docstore is None if with_payload is None else with_payload, **kwargs)
+
+    def document(self, point: Any) -> Document:
+        """the chunk in the payload of a point"""
+        return Document(page_content=point.payload.get(self.content_payload_key), metadata=point.payload.get(self.metadata_payload_key) or {})
+
+    def documents(self, points: list[Any]) -> list[Document]:
+        """the chunks of points, from their payloads, from the docstore, or else retrieved from the index, with their similarity to the query as "score" metadata"""
+        ids = [uuid.UUID(str(point.id)).hex for point in points]  # qdrant returns the md5 IDs as UUIDs
+        found = {key: self.document(point) for point, key in zip(points, ids) if point.payload}
+        if self.docstore is not None:
+            found |= self.docstore.get([key for key in ids if key not in found])
+        # searched without payloads, or ingested before the docstore was enabled
+        if missing := [point.id for point, key in zip(points, ids) if key not in found]:
+            for point in self.index.retrieve(missing):
+                found[uuid.UUID(str(point.id)).hex] = self.document(point)
+        for point, key in zip(points, ids):
+            found[key].metadata["score"] = point.score
+        return [found[key] for key in ids]
+
+    def check_filter(self, filter: dict | None) -> None:
+        """metadata filters are applied by the index, so they need the metadata in the payloads"""
+        if filter and self.docstore is not None:
+            raise ValueError("Metadata filters need the metadata in the payloads, disable CHUNK_DOCSTORE")
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None) -> list[tuple[Document, float]]:
+        self.check_filter(filter)
+        results = self.search(self.embeddings.embed_query(query), k, filter=filter)
+        return list(zip(self.documents(results), (result.score for result in results)))
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> list[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def max_marginal_relevance_search(
+        self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = mmr_lambda, filter: Optional[dict] = None, **kwargs: Any
+    ) -> list[Document]:
+        """fetch the vectors of fetch_k candidates in one search, and the chunks of the k selected ones only"""
+        self.check_filter(filter)
+        embedding = self.embeddings.embed_query(query)
+        results = self.search(embedding, fetch_k, with_payload=False, with_vectors=True, filter=filter)
+        return self.documents([results[i] for i in mmr_select(embedding, [result.vector for result in results], k, lambda_mult)])
@@ -0,0 +1,42 @@
+"""watch a directory for created, modified and deleted files"""
+import os
+import time
+from pathlib import Path
+
+
+class DirectoryWatcher:
+    """polls a directory tree when asked, and reports files once they have stopped changing
+    Polling needs no dependency and, unlike inotify, also sees changes made on network shares by other machines.
+    A file which changes several times within debounce seconds (e.g. while being copied) is reported once, after its last change.
+    """
+
+    def __init__(self, path: str, debounce: float = 5):
+        self.path = path
+        self.debounce = debounce
+        self.snapshot = self.scan()
+        self.unsettled: dict[str, float] = {}  # file -> time of its last change
+
+    def scan(self) -> dict[str, tuple[int, float]]:
+        """size and mtime of every file under the directory"""
+        snapshot = {}
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                filepath = os.path.join(root, file)
+                try:
+                    st = os.stat(filepath)
+                except FileNotFoundError:  # deleted while walking
+                    continue
+                snapshot[str(Path(filepath).resolve())] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def poll(self) -> tuple[list[Path], list[str]]:
+        """files created or modified, and files deleted, which haven't changed for debounce seconds"""
+        now, snapshot = time.monotonic(), self.scan()
+        for key in snapshot.keys() | self.snapshot.keys():
+            if snapshot.get(key) != self.snapshot.get(key):
+                self.unsettled[key] = now
+        self.snapshot = snapshot
+        settled = [key for key, changed in self.unsettled.items() if now - changed >= self.debounce]
+        for key in settled:
+            del self.unsettled[key]
+        return [Path(key) for key in settled if key in snapshot], [key for key in settled if key not in snapshot]